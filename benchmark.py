@@ -0,0 +1,362 @@
+#!/usr/bin/python
+"""
+Measure how long mgp2pdf takes to convert presentations.
+
+Use: benchmark.py [options] [filename.mgp ...]
+
+Without filenames, benchmark.py converts every presentation in samples/,
+plus a set of generated ones that stress particular code paths:
+
+    many-slides     -- thousands of short slides
+    long-lines      -- paragraphs that need a lot of word-wrapping
+    many-images     -- several images on every slide
+    many-defaults   -- %default rules for most of the lines on a page
+
+Each conversion is split into four phases that are timed separately:
+
+    load            -- Presentation.load()
+    wordWrap        -- Slide.wordWrap() for every slide
+    drawOn          -- Slide.drawOn() for every slide
+    save            -- Canvas.save()
+
+With --memory, benchmark.py also measures the Python heap used by each
+presentation (with tracemalloc): after loading it, after word-wrapping it,
+and the peak in between.  For example, to measure a presentation with
+10,000 slides, use
+
+    benchmark.py --memory --no-samples --scale 3.34
+
+and look at synthetic/many-slides.mgp.
+
+With --fonts, benchmark.py also times resolving a set of font patterns
+with fc-match and with the built-in font index (--font-index), including
+the time it takes to build the index.
+
+Every presentation is converted --repeat times, each time as if by a fresh
+mgp2pdf process (the in-memory caches are cleared, and the on-disk ones are
+not used); the best time of each phase is reported along with all the
+individual runs.  The results are written as JSON to stdout (or to the file
+given with -o), so they can be compared across releases.
+
+%filter commands are run only with --unsafe.
+"""
+
+import gc
+import glob
+import io
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import reportlab
+
+import mgp2pdf
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+FORMAT_VERSION = 1
+
+PHASES = ['load', 'wordWrap', 'drawOn', 'save']
+
+WORDS = """
+    lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod
+    tempor incididunt ut labore et dolore magna aliqua
+""".split()
+
+
+# Patterns like the ones Fonts.define() makes out of %deffont xfont names
+FONT_PATTERNS = [
+    'sans', 'serif', 'monospace', 'helvetica', 'times', 'courier',
+    'sans:weight=200', 'serif:weight=200:slant=italic', 'monospace:weight=200',
+    'arial:weight=200:slant=italic', 'times:slant=italic',
+]
+
+
+def words(n, start=0):
+    return ' '.join(WORDS[(start + i) % len(WORDS)] for i in range(n))
+
+
+def make_many_slides(scale):
+    lines = ['%default 1 area 90 90, size 7, fore "white", back "black"\n',
+             '%default 2 size 5, fore "yellow"\n']
+    for n in range(int(3000 * scale) or 1):
+        lines.append('%%page\n\nSlide %d\n' % n)
+        for i in range(6):
+            lines.append(words(8, n + i) + '\n')
+    return ''.join(lines)
+
+
+def make_long_lines(scale):
+    lines = ['%default 1 area 90 90, size 4\n']
+    for n in range(int(20 * scale) or 1):
+        lines.append('%page\n\n')
+        for i in range(3):
+            lines.append(words(1000, n + i) + '\n')
+    return ''.join(lines)
+
+
+def make_many_images(scale, directory):
+    from PIL import Image
+    for i in range(4):
+        Image.new('RGB', (64 * (i + 1), 48 * (i + 1)),
+                  (60 * i, 100, 200)).save(
+            os.path.join(directory, 'image%d.png' % i))
+    lines = ['%default 1 area 90 90, size 5\n']
+    for n in range(int(500 * scale) or 1):
+        lines.append('%%page\n\nImages %d\n' % n)
+        for i in range(4):
+            lines.append('%%newimage -zoom %d "image%d.png"\n'
+                         % (50 + 10 * i, i))
+            lines.append(words(5, n + i) + '\n')
+    return ''.join(lines)
+
+
+def make_many_defaults(scale):
+    lines = ['%default 1 area 90 90, vgap 20, size 7, center, fore "white"\n']
+    for i in range(2, 30):
+        lines.append('%%default %d size %d, fore "#%02x%02x00", left, vgap 30\n'
+                     % (i, 3 + i % 4, i * 8, 255 - i * 8))
+    for n in range(int(1000 * scale) or 1):
+        lines.append('%page\n\n')
+        for i in range(25):
+            lines.append(words(6, n + i) + '\n')
+    return ''.join(lines)
+
+
+def make_synthetic_decks(directory, scale=1.0):
+    """Write the generated presentations into a directory.
+
+    Returns a list of filenames.
+    """
+    decks = [
+        ('many-slides', make_many_slides(scale)),
+        ('long-lines', make_long_lines(scale)),
+        ('many-images', make_many_images(scale, directory)),
+        ('many-defaults', make_many_defaults(scale)),
+    ]
+    filenames = []
+    for name, text in decks:
+        filename = os.path.join(directory, name + '.mgp')
+        with open(filename, 'w') as f:
+            f.write(text)
+        filenames.append(filename)
+    return filenames
+
+
+def sample_decks():
+    return sorted(glob.glob(os.path.join(here, 'samples', '*', '*.mgp')))
+
+
+def reset_caches():
+    """Forget everything mgp2pdf keeps in memory between conversions.
+
+    This includes the parsed fonts, font lookups, images and text styles
+    that are shared by all the presentations converted in one process.
+    """
+    mgp2pdf.image_cache.clear()
+    mgp2pdf.TextStyle.clearInterned()
+    mgp2pdf.Fonts._parsed.clear()
+    mgp2pdf.Fonts._resolved.clear()
+    mgp2pdf.Fonts._index = None
+    mgp2pdf.parse_color.cache_clear()
+
+
+def convert(filename, unsafe=False):
+    """Convert a presentation into an in-memory PDF, timing each phase.
+
+    Returns (number of slides, {phase: seconds}).
+    """
+    timings = {}
+    start = time.perf_counter()
+    p = mgp2pdf.Presentation(unsafe=unsafe)
+    p.load(filename)
+    timings['load'] = time.perf_counter() - start
+    canvas = mgp2pdf.PresentationCanvas(io.BytesIO(), p.pageSize)
+    start = time.perf_counter()
+    for slide in p.slides:
+        x, y, w, h = slide.areaBox(p.pageSize)
+        slide.wordWrap(canvas, w, h)
+    timings['wordWrap'] = time.perf_counter() - start
+    start = time.perf_counter()
+    for slide in p.slides:
+        slide.drawOn(canvas, p.pageSize)
+        canvas.showPage()
+    timings['drawOn'] = time.perf_counter() - start
+    start = time.perf_counter()
+    canvas.save()
+    timings['save'] = time.perf_counter() - start
+    return len(p.slides), timings
+
+
+def measure_memory(filename, unsafe=False):
+    """Measure the Python heap used by a presentation.
+
+    Returns a dict with the number of bytes in use after loading the
+    presentation, after word-wrapping it, and at peak.
+    """
+    reset_caches()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        p = mgp2pdf.Presentation(unsafe=unsafe)
+        p.load(filename)
+        gc.collect()
+        loaded = tracemalloc.get_traced_memory()[0]
+        canvas = mgp2pdf.PresentationCanvas(io.BytesIO(), p.pageSize)
+        for slide in p.slides:
+            x, y, w, h = slide.areaBox(p.pageSize)
+            slide.wordWrap(canvas, w, h)
+        gc.collect()
+        wrapped, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return dict(load=loaded, wordWrap=wrapped, peak=peak)
+
+
+def timings(runs):
+    return dict(best=min(runs), runs=runs)
+
+
+def benchmark(filename, name, repeat=3, unsafe=False):
+    """Benchmark a presentation.
+
+    Returns a dict suitable for JSON output.
+    """
+    runs = {phase: [] for phase in PHASES}
+    for n in range(repeat):
+        # Start each run with a clean slate, so every run includes parsing
+        # fonts and images, as a single mgp2pdf invocation would
+        reset_caches()
+        slides, phases = convert(filename, unsafe=unsafe)
+        for phase in PHASES:
+            runs[phase].append(phases[phase])
+    return dict(
+        name=name,
+        slides=slides,
+        phases={phase: timings(runs[phase]) for phase in PHASES},
+        total=sum(min(runs[phase]) for phase in PHASES),
+    )
+
+
+def benchmark_fonts(repeat=3):
+    """Compare font lookups with fc-match and with the FontIndex.
+
+    Returns a dict suitable for JSON output.  The fc-match timings are
+    None if fc-match is not installed.
+    """
+    directories = [os.path.expanduser(d) for d in mgp2pdf.Fonts.fontDirectories]
+    runs = dict(indexBuild=[], indexLookup=[], fcMatch=[])
+    for n in range(repeat):
+        start = time.perf_counter()
+        index = mgp2pdf.FontIndex(directories)
+        runs['indexBuild'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for pattern in FONT_PATTERNS:
+            index.match(pattern)
+        runs['indexLookup'].append(time.perf_counter() - start)
+        if shutil.which('fc-match'):
+            start = time.perf_counter()
+            for pattern in FONT_PATTERNS:
+                mgp2pdf.Fonts._fcMatch(pattern)
+            runs['fcMatch'].append(time.perf_counter() - start)
+    return dict(
+        patterns=len(FONT_PATTERNS),
+        families=len(index.families),
+        phases={phase: timings(runs[phase]) if runs[phase] else None
+                for phase in runs},
+    )
+
+
+def git_revision():
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=here,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL).stdout
+    except OSError:
+        return None
+    return output.decode().strip() or None
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage='%prog [options] [filename.mgp ...]',
+        description="Benchmark mgp2pdf and print the results as JSON.")
+    parser.add_option('-o', dest='outfile',
+                      help="write the results to this file")
+    parser.add_option('-n', '--repeat', type='int', default=3, metavar='N',
+                      help="convert each presentation N times (default: 3)")
+    parser.add_option('--scale', type='float', default=1.0,
+                      help="scale the size of the generated presentations"
+                           " (default: 1.0)")
+    parser.add_option('--no-samples', action='store_false', default=True,
+                      dest='samples',
+                      help="skip the presentations in samples/")
+    parser.add_option('--no-synthetic', action='store_false', default=True,
+                      dest='synthetic',
+                      help="skip the generated presentations")
+    parser.add_option('--memory', action='store_true', default=False,
+                      help="also measure memory use (slow)")
+    parser.add_option('--fonts', action='store_true', default=False,
+                      help="also compare font lookups with fc-match and"
+                           " with the font index")
+    parser.add_option('--unsafe', action='store_true', default=False,
+                      help="enable %filter")
+    opts, args = parser.parse_args()
+    if opts.repeat < 1:
+        parser.error("--repeat expects a positive number")
+    if opts.scale <= 0:
+        parser.error("--scale expects a positive number")
+    tmpdir = tempfile.mkdtemp(prefix='mgp2pdf-benchmark-')
+    try:
+        decks = [(fn, os.path.relpath(fn)) for fn in args]
+        if not args and opts.samples:
+            decks += [(fn, os.path.relpath(fn, here))
+                      for fn in sample_decks()]
+        if not args and opts.synthetic:
+            decks += [(fn, 'synthetic/' + os.path.basename(fn))
+                      for fn in make_synthetic_decks(tmpdir, opts.scale)]
+        results = []
+        for filename, name in decks:
+            print("Benchmarking %s" % name, file=sys.stderr)
+            result = benchmark(filename, name, repeat=opts.repeat,
+                               unsafe=opts.unsafe)
+            if opts.memory:
+                result['memory'] = measure_memory(filename,
+                                                  unsafe=opts.unsafe)
+            results.append(result)
+        if opts.fonts:
+            print("Benchmarking font lookups", file=sys.stderr)
+            fonts = benchmark_fonts(repeat=opts.repeat)
+    finally:
+        shutil.rmtree(tmpdir)
+    report = dict(
+        format=FORMAT_VERSION,
+        revision=git_revision(),
+        python='%s %s' % (platform.python_implementation(),
+                          platform.python_version()),
+        reportlab=reportlab.Version,
+        platform=platform.platform(),
+        repeat=opts.repeat,
+        scale=opts.scale,
+        decks=results,
+    )
+    if opts.fonts:
+        report['fonts'] = fonts
+    output = json.dumps(report, indent=2) + '\n'
+    if opts.outfile:
+        with open(opts.outfile, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,19 +3,43 @@
 A quick-and-dirty MagicPoint to PDF converter.
 """
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import fnmatch
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
+import math
 import optparse
 import os
+import pickle
+import queue
 import re
+import shutil
+import signal
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import weakref
 
+import reportlab
+from reportlab import rl_config
 from reportlab.lib.colors import HexColor, black
 from reportlab.lib.pagesizes import landscape
 from reportlab.lib.units import inch
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.ttfonts import TTEncoding, TTFont, TTFontFace
 from reportlab.pdfgen.canvas import Canvas
 
 
@@ -30,6 +54,14 @@ class MgpSyntaxError(Exception):
     pass
 
 
+class FilterError(Exception):
+    """A %filter command ran for too long or produced too much output."""
+
+
+class _FilterCancelled(Exception):
+    """The output of a %filter command is no longer wanted."""
+
+
 COLORS = dict(
     black="#000",
     white="#fff",
@@ -41,6 +73,7 @@ COLORS = dict(
 )
 
 
+@functools.lru_cache(maxsize=256)
 def parse_color(color):
     """Parse a named color or '#rgb'/'#rrggbb'
 
@@ -56,6 +89,12 @@ def parse_color(color):
         >>> parse_color('white')
         Color(1,1,1,1)
 
+    The same color object is returned for the same color name, so the
+    result must not be modified.
+
+        >>> parse_color('#fff') is parse_color('#fff')
+        True
+
     """
     color = COLORS.get(color, color)
     if len(color) == 4 and color.startswith('#'):
@@ -66,6 +105,9 @@ def parse_color(color):
     return HexColor(color)
 
 
+_wrap_position_rx = re.compile(r'(?<=\S)(?=\s)')
+
+
 def textWrapPositions(s):
     """Find all break points in text, starting from the rightmost.
 
@@ -75,13 +117,231 @@ def textWrapPositions(s):
         [12, 7, 1]
 
     """
-    poses = [len(s)]
-    for idx in range(len(s) - 1, 0, -1):
-        if not s[idx - 1].isspace() and s[idx].isspace():
-            poses.append(idx)
+    poses = [m.start() for m in _wrap_position_rx.finditer(s)]
+    poses.append(len(s))
+    poses.reverse()
     return poses
 
 
+class PresentationCanvas(Canvas):
+    """A ReportLab canvas with per-document caches.
+
+    Word-wrapping measures the same strings over and over again (every
+    wrapping attempt, every ``Line.size()`` and ``Line.drawOn()``), so
+    ``stringWidth()`` results are memoized in a bounded LRU cache keyed
+    by (text, font name, font size).  The cache lives as long as the
+    canvas, i.e. it is shared by all the slides of a single PDF.
+
+    ``prefixWidths()`` measures all the prefixes of a string at once,
+    which is what word-wrapping needs.
+
+    Images drawn by filename are embedded into the PDF once, as named
+    XObjects, and later ``drawImage()`` calls for the same file just
+    reference them.
+
+    If ``maxImageDPI`` is specified, images that would be drawn at a
+    higher resolution are downsampled before embedding.  Downsampled
+    images are stored in ``imageCacheDir`` (if specified) and reused
+    in subsequent runs.
+    """
+
+    widthCacheSize = 16384
+
+    def __init__(self, *args, **kw):
+        self.maxImageDPI = kw.pop('maxImageDPI', None)
+        self.imageCacheDir = kw.pop('imageCacheDir', None)
+        self._tmpdir = None
+        self._downsampled = {}
+        Canvas.__init__(self, *args, **kw)
+        self._stringWidth = functools.lru_cache(maxsize=self.widthCacheSize)(
+            pdfmetrics.stringWidth)
+        self._advanceTables = {}
+        self._images = {}
+        self.imagesEmbedded = 0
+        self.imagesReferenced = 0
+
+    def stringWidth(self, text, fontName=None, fontSize=None):
+        """Compute the width of a string in points."""
+        if fontName is None:
+            fontName = self._fontname
+        if fontSize is None:
+            fontSize = self._fontsize
+        return self._stringWidth(text, fontName, fontSize)
+
+    def prefixWidths(self, text, fontName, fontSize, limit=None):
+        """Compute the widths of the prefixes of a string.
+
+        Returns a list of widths in points, where the Nth item is the
+        width of ``text[:N]``, or None if the font is not a TrueType font.
+        The list has ``len(text) + 1`` items, unless ``limit`` is
+        specified, in which case it stops at the first prefix that is
+        wider than ``limit``.
+
+        The widths are computed the same way as ReportLab's
+        ``stringWidth()`` does it, but with a running sum instead of
+        measuring every prefix separately.
+        """
+        table = self._advanceTable(fontName)
+        if table is None:
+            return None
+        advances, charWidths, defaultWidth = table
+
+        def advance(c):
+            return charWidths.get(c, defaultWidth)
+
+        scale = 0.001 * fontSize
+        result = [0]
+        total = 0
+        start = 0
+        step = 64
+        # With a limit, measure in growing pieces so we can stop early
+        # without looking at the rest of a long string.
+        while start < len(text):
+            piece = text[start:start + step] if limit is not None else text
+            if ord(max(piece)) < len(advances):
+                widths = map(advances.__getitem__, map(ord, piece))
+            else:
+                widths = map(advance, map(ord, piece))
+            sums = list(itertools.accumulate(widths, initial=total))
+            total = sums[-1]
+            result += [scale * width for width in sums[1:]]
+            if limit is not None and result[-1] > limit:
+                del result[bisect.bisect_right(result, limit) + 1:]
+                break
+            start += len(piece)
+            step *= 2
+        return result
+
+    def _advanceTable(self, fontName):
+        """Return a per-codepoint advance width table of a TrueType font.
+
+        Returns (array of advance widths for the Basic Multilingual Plane,
+        dict of all advance widths, default advance width), or None for
+        non-TrueType fonts.
+        """
+        try:
+            return self._advanceTables[fontName]
+        except KeyError:
+            pass
+        font = pdfmetrics.getFont(fontName)
+        table = None
+        if isinstance(font, TTFont):
+            face = font.face
+            bmp = [c for c in face.charWidths if c < 0x10000]
+            advances = array.array('d', [face.defaultWidth]) * (
+                max(bmp, default=-1) + 1)
+            for c in bmp:
+                advances[c] = face.charWidths[c]
+            table = (advances, face.charWidths, face.defaultWidth)
+        self._advanceTables[fontName] = table
+        return table
+
+    def widthCacheInfo(self):
+        """Return text width cache statistics.
+
+        Returns a named tuple with ``hits``, ``misses``, ``maxsize`` and
+        ``currsize`` fields (see ``functools.lru_cache``).
+        """
+        return self._stringWidth.cache_info()
+
+    def drawImage(self, image, x, y, width=None, height=None, mask=None,
+                  **kw):
+        """Draw an image (ImageReader object or filename).
+
+        See ``reportlab.pdfgen.canvas.Canvas.drawImage`` for details.
+        """
+        key = None
+        if isinstance(image, str) and width is not None and height is not None and not kw:
+            if self.maxImageDPI:
+                image = self.downsampleImage(image, width, height)
+            key = (image, mask)
+            if key in self._images:
+                name, imgsize = self._images[key]
+                self.saveState()
+                self.translate(x, y)
+                self.scale(width, height)
+                self.doForm(name)
+                self.restoreState()
+                self.imagesReferenced += 1
+                return imgsize
+        extra = kw.pop('extraReturn', None) or {}
+        extra['name'] = None
+        imgsize = Canvas.drawImage(self, image, x, y, width, height, mask,
+                                   extraReturn=extra, **kw)
+        if key is not None:
+            self._images[key] = (extra['name'], imgsize)
+        self.imagesEmbedded += 1
+        return imgsize
+
+    def downsampleImage(self, filename, width, height):
+        """Downsample an image to ``self.maxImageDPI``, if necessary.
+
+        ``width`` and ``height`` specify the size of the image on the page,
+        in points.
+
+        Returns the filename of the downsampled image, or the original
+        filename if no downsampling is needed.
+        """
+        iw, ih = image_cache.get(filename).getSize()
+        tw = max(1, int(math.ceil(abs(width) * self.maxImageDPI / 72)))
+        th = max(1, int(math.ceil(abs(height) * self.maxImageDPI / 72)))
+        if tw >= iw and th >= ih:
+            return filename
+        key = (filename, tw, th)
+        if key not in self._downsampled:
+            self._downsampled[key] = self._downsample(filename, tw, th)
+        return self._downsampled[key]
+
+    def _downsample(self, filename, tw, th):
+        with open(filename, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        ext = os.path.splitext(filename)[1].lower()
+        if ext not in ('.jpg', '.jpeg'):
+            ext = '.png'
+        directory = self.imageCacheDir
+        if not directory:
+            if self._tmpdir is None:
+                self._tmpdir = tempfile.mkdtemp(prefix='mgp2pdf-')
+            directory = self._tmpdir
+        resized = os.path.join(directory, '%s-%dx%d%s' % (digest, tw, th, ext))
+        if not os.path.exists(resized):
+            from PIL import Image as PILImage
+            img = PILImage.open(filename)
+            if ext == '.png':
+                if img.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+                    img = img.convert('RGBA')
+            elif img.mode not in ('RGB', 'L'):
+                # JPEG supports neither alpha nor CMYK here
+                img = img.convert('RGB')
+            img = img.resize((tw, th), PILImage.LANCZOS)
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, suffix=ext)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    img.save(f, 'PNG' if ext == '.png' else 'JPEG')
+                os.replace(tmpname, resized)
+            except Exception:
+                os.unlink(tmpname)
+                raise
+        return resized
+
+    def save(self):
+        """Write the PDF and clean up temporary files."""
+        try:
+            Canvas.save(self)
+        finally:
+            self.cleanUp()
+
+    def cleanUp(self):
+        """Remove temporary files (downsampled images).
+
+        ``save()`` does this; call it if the PDF is abandoned instead.
+        """
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir)
+            self._tmpdir = None
+
+
 class Slide(object):
     """Presentation page builder.
 
@@ -92,6 +352,9 @@ class Slide(object):
     There's also a set of methods for building the slides incrementally.
     """
 
+    __slots__ = ('lines', '_cur_line', 'font', 'size', 'vgap', 'area',
+                 'color', 'alignment', 'prefix', 'wrapped')
+
     def __init__(self):
         self.lines = []
         self._cur_line = None
@@ -102,6 +365,20 @@ class Slide(object):
         self.color = black
         self.alignment = Left
         self.prefix = 0
+        self.wrapped = False
+
+    # Pickle as a tuple, which is smaller and faster to load than the
+    # default (a dict of slot values)
+
+    def __getstate__(self):
+        return (self.lines, self._cur_line, self.font, self.size, self.vgap,
+                self.area, self.color, self.alignment, self.prefix,
+                self.wrapped)
+
+    def __setstate__(self, state):
+        (self.lines, self._cur_line, self.font, self.size, self.vgap,
+         self.area, self.color, self.alignment, self.prefix,
+         self.wrapped) = state
 
     def setArea(self, w, h):
         """Change the slide area.
@@ -221,6 +498,13 @@ class Slide(object):
         """Represent the contents of the slide as text."""
         return '\n'.join(map(str, self.lines))
 
+    def cacheKey(self):
+        """Describe everything that affects the layout of this slide.
+
+        Returns a tuple that can be ``repr()``ed and hashed.
+        """
+        return (self.area, [line.cacheKey() for line in self.lines])
+
     def wordWrap(self, canvas, w, h):
         """Perform word-wrapping.
 
@@ -238,22 +522,46 @@ class Slide(object):
         for line in self.lines:
             new_lines += line.split(canvas, w, h)
         self.lines = new_lines
+        self.wrapped = True
 
-    def drawOn(self, canvas, pageSize):
-        """Draw the current slide on a ReportLab canvas.
+    def areaBox(self, pageSize):
+        """Compute the slide area.
 
         ``pageSize`` is a tuple (width, height), in points.
 
         The slide is centered on the page, occupying a certain
         percentage of it, as specified via ``setArea()``.
+
+        Returns (x, y, w, h) where (x, y) is the top-left corner, in
+        points.
         """
-        # canvas.bookmarkPage(title)
-        # canvas.addOutlineEntry(title, title, outlineLevel)
         w = pageSize[0] * self.area[0] / 100
         h = pageSize[1] * self.area[1] / 100
         x = (pageSize[0] - w) / 2
         y = (pageSize[1] + h) / 2
-        self.wordWrap(canvas, w, h)
+        return x, y, w, h
+
+    def layOut(self, canvas, pageSize):
+        """Perform word-wrapping for a given page size, unless already done.
+
+        ``pageSize`` is a tuple (width, height), in points.
+        """
+        if not self.wrapped:
+            x, y, w, h = self.areaBox(pageSize)
+            self.wordWrap(canvas, w, h)
+
+    def drawOn(self, canvas, pageSize):
+        """Draw the current slide on a ReportLab canvas.
+
+        ``pageSize`` is a tuple (width, height), in points.
+
+        The slide is centered on the page, occupying a certain
+        percentage of it, as specified via ``setArea()``.
+        """
+        # canvas.bookmarkPage(title)
+        # canvas.addOutlineEntry(title, title, outlineLevel)
+        x, y, w, h = self.areaBox(pageSize)
+        self.layOut(canvas, pageSize)
         for p in self.lines:
             x, y = p.drawOn(canvas, x, y, w, h)
 
@@ -288,6 +596,8 @@ class Center(object):
 class Line(object):
     """A line of text (and images)."""
 
+    __slots__ = ('chunks', 'alignment', 'prefix')
+
     def __init__(self, alignment=Left, prefix=0):
         self.chunks = []
         self.alignment = alignment
@@ -296,6 +606,12 @@ class Line(object):
         # XXX prefix can be a string (usually of whitespace), but that is not
         # yet implemented in size(), split() nor drawOn().
 
+    def __getstate__(self):
+        return (self.chunks, self.alignment, self.prefix)
+
+    def __setstate__(self, state):
+        self.chunks, self.alignment, self.prefix = state
+
     def cloneStyle(self, newchunks):
         """Create a new Line with the same style but different contents."""
         clone = Line(self.alignment, self.prefix)
@@ -347,31 +663,39 @@ class Line(object):
         Returns a list of Line objects that are supposed to fit inside
         the requested width.
         """
-        chunks_that_fit = []
-        remaining_chunks = list(self.chunks)
+        lines = []
+        remaining_chunks = collections.deque(self.chunks)
         remaining_space = w
         if isinstance(self.prefix, int):
             w = w * (100 - self.prefix) / 100
-        while remaining_chunks:
-            chunk = remaining_chunks.pop(0)
-            cw, ch = chunk.size(canvas, w, h)
-            if cw <= remaining_space:
-                chunks_that_fit.append(chunk)
-                remaining_space -= cw
-            else:
+        while True:
+            chunks_that_fit = []
+            while remaining_chunks:
+                chunk = remaining_chunks.popleft()
+                if not chunk.tooWide(canvas, w, h, remaining_space):
+                    cw, ch = chunk.size(canvas, w, h)
+                    if cw <= remaining_space:
+                        chunks_that_fit.append(chunk)
+                        remaining_space -= cw
+                        continue
                 bits = chunk.split(canvas, w, h, remaining_space)
                 cw, ch = bits[0].size(canvas, w, h)
                 if cw <= remaining_space:
                     chunks_that_fit.append(bits.pop(0))
-                remaining_chunks = bits + remaining_chunks
+                remaining_chunks.extendleft(reversed(bits))
                 break
-        if not chunks_that_fit and remaining_chunks:
-            chunks_that_fit.append(remaining_chunks.pop(0))
-        if remaining_chunks:
-            return ([self.cloneStyle(chunks_that_fit)] +
-                    self.cloneStyle(remaining_chunks).split(canvas, w, h))
-        else:
+            if not chunks_that_fit and remaining_chunks:
+                chunks_that_fit.append(remaining_chunks.popleft())
+            if not remaining_chunks:
+                break
+            lines.append(self.cloneStyle(chunks_that_fit))
+            # The continuation lines are cloned without the prefix, so they
+            # get the (already reduced) width available after the prefix.
+            remaining_space = w
+        if not lines:
             return [self]
+        lines.append(self.cloneStyle(chunks_that_fit))
+        return lines
 
     def drawOn(self, canvas, x, y, w, h):
         """Render the line.
@@ -404,10 +728,17 @@ class Line(object):
         """Represent the contents of the line as text."""
         return ''.join(map(str, self.chunks))
 
+    def cacheKey(self):
+        """Describe everything that affects the layout of this line."""
+        return (self.alignment.__name__, self.prefix,
+                [chunk.cacheKey() for chunk in self.chunks])
+
 
 class SimpleChunk(object):
     """A simple chunk that takes no space, is invisible, and unsplittable."""
 
+    __slots__ = ()
+
     def size(self, canvas, w, h):
         """Compute the size of this chunk.
 
@@ -420,6 +751,15 @@ class SimpleChunk(object):
         """
         return 0, 0
 
+    def tooWide(self, canvas, w, h, maxw):
+        """Check whether this chunk is wider than ``maxw``.
+
+        This is a shortcut that lets word-wrapping avoid measuring long
+        chunks in full.  It may return False when unsure; the caller will
+        then compare ``size()`` with ``maxw``.
+        """
+        return False
+
     def drawOn(self, canvas, x, y, w, h):
         """Render the chunk on canvas.
 
@@ -454,10 +794,16 @@ class SimpleChunk(object):
         """Represent the contents of the chunk as text."""
         return '<%s>' % self.__class__.__name__
 
+    def cacheKey(self):
+        """Describe everything that affects the layout of this chunk."""
+        return (self.__class__.__name__, )
+
 
 class Mark(SimpleChunk):
     """A position marker."""
 
+    __slots__ = ('pos', )
+
     def __init__(self):
         self.pos = None
 
@@ -472,6 +818,8 @@ class Mark(SimpleChunk):
 class Again(SimpleChunk):
     """Move to a position marker."""
 
+    __slots__ = ('mark', )
+
     def __init__(self, mark):
         self.mark = mark
 
@@ -484,14 +832,64 @@ class Again(SimpleChunk):
         return '<again>'
 
 
+class ImageCache(object):
+    """A registry of images, shared by all presentations in this process.
+
+    Each image file is opened and decoded once, no matter how many times
+    it's used, as long as it doesn't change on disk.
+    """
+
+    def __init__(self):
+        self._readers = {}
+
+    def get(self, filename):
+        """Return an ImageReader for a given file."""
+        path = os.path.abspath(filename)
+        stamp = fileStamp(path)
+        cached = self._readers.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        reader = ImageReader(filename)
+        if stamp is not None:
+            self._readers[path] = (stamp, reader)
+        return reader
+
+    def clear(self):
+        """Forget all cached images."""
+        self._readers.clear()
+
+
+image_cache = ImageCache()
+
+
 class Image(SimpleChunk):
-    """An image."""
+    """An image.
+
+    The image file is not opened until its size is needed.
+    """
+
+    __slots__ = ('filename', 'zoom', 'raised_by', '_image')
 
     def __init__(self, filename, zoom=100, raised_by=0):
         self.filename = filename
         self.zoom = zoom
         self.raised_by = raised_by
-        self.image = ImageReader(filename)
+        self._image = None
+
+    @property
+    def image(self):
+        """The ImageReader for this image."""
+        if self._image is None:
+            self._image = image_cache.get(self.filename)
+        return self._image
+
+    def __getstate__(self):
+        # Don't pickle the decoded image, it can be loaded again
+        return (self.filename, self.zoom, self.raised_by)
+
+    def __setstate__(self, state):
+        self.filename, self.zoom, self.raised_by = state
+        self._image = None
 
     def size(self, canvas, w, h):
         myw, myh = self.image.getSize()
@@ -514,20 +912,78 @@ class Image(SimpleChunk):
     def __str__(self):
         return '[%s]' % self.filename
 
+    def cacheKey(self):
+        return (self.__class__.__name__, self.filename, self.zoom,
+                self.raised_by, fileStamp(self.filename))
+
+
+class TextStyle(collections.namedtuple(
+        'TextStyle', 'font fontSize vgap color')):
+    """The style of a TextChunk.
+
+    Styles are immutable and interned: ``TextStyle.get()`` returns the
+    same object for the same style, so all the chunks of a presentation
+    (and all the fragments they're word-wrapped into) that look the same
+    share one TextStyle.
+    """
+
+    __slots__ = ()
+
+    _interned = {}
+
+    @classmethod
+    def get(cls, font, fontSize, vgap, color):
+        """Return the interned TextStyle with these attributes."""
+        style = cls(font, fontSize, vgap, color)
+        return cls._interned.setdefault(style, style)
+
+    @classmethod
+    def clearInterned(cls):
+        """Forget the interned styles.
+
+        Existing styles remain valid, they just won't be shared with new
+        ones.  (Tuples can't be weakly referenced, so the interning table
+        has to be cleared explicitly.)
+        """
+        cls._interned.clear()
+
+    def __reduce__(self):
+        # Intern unpickled styles too
+        return (TextStyle.get, tuple(self))
+
 
 class TextChunk(object):
     """A chunk of text."""
 
+    __slots__ = ('text', 'style')
+
+    # Width difference (in points) that is certainly not a rounding error
+    tolerance = 1e-6
+
+    # Text shorter than this is measured with stringWidth(), which is
+    # memoized; longer text is measured in bulk with prefixWidths()
+    bulkMeasureThreshold = 400
+
     def __init__(self, text, font, fontSize, vgap, color):
         self.text = text
-        self.font = font
-        self.fontSize = fontSize
-        self.vgap = vgap
-        self.color = color
+        self.style = TextStyle.get(font, fontSize, vgap, color)
+
+    font = property(lambda self: self.style.font)
+    fontSize = property(lambda self: self.style.fontSize)
+    vgap = property(lambda self: self.style.vgap)
+    color = property(lambda self: self.style.color)
+
+    def __getstate__(self):
+        return (self.text, self.style)
+
+    def __setstate__(self, state):
+        self.text, self.style = state
 
     def cloneStyle(self, newtext):
-        return TextChunk(newtext, self.font, self.fontSize, self.vgap,
-                         self.color)
+        clone = TextChunk.__new__(TextChunk)
+        clone.text = newtext
+        clone.style = self.style
+        return clone
 
     def _splitIntoRuns(self, text=None):
         if text is None:
@@ -567,14 +1023,135 @@ class TextChunk(object):
                 x = txt.getX()
         return x, y
 
-    def split(self, canvas, w, h, maxw):
-        for pos in textWrapPositions(self.text):
-            myw = self.size(canvas, w, h, self.text[:pos])[0]
-            if myw <= maxw:
-                return [self.cloneStyle(self.text[:pos]),
-                        self.cloneStyle(self.text[pos:].lstrip())]
-        if pos < len(self.text):
+    def prefixWidths(self, canvas, w, h, maxw):
+        """Compute the widths of the prefixes of this chunk.
+
+        Returns a list of widths, where the Nth item is the width of
+        ``self.text[:N]``.  The list stops at the first prefix that is
+        wider than ``maxw``.
+
+        Returns None if the canvas cannot measure prefixes in bulk.
+        """
+        if not isinstance(canvas, PresentationCanvas):
+            return None
+        fontSize, leading, tabsize = self._calcSizes(w, h)
+        result = [0]
+        textwidth = 0
+        for run in self._splitIntoRuns():
+            if textwidth > maxw:
+                break
+            if run == '\t':
+                textwidth = textwidth + tabsize - textwidth % tabsize
+                result.append(textwidth)
+            elif run:
+                widths = canvas.prefixWidths(run, self.font, fontSize,
+                                             maxw - textwidth)
+                if widths is None:
+                    return None
+                if textwidth:
+                    widths = [textwidth + width for width in widths]
+                result += widths[1:]
+                textwidth = result[-1]
+        return result
+
+    def tooWide(self, canvas, w, h, maxw):
+        if len(self.text) < self.bulkMeasureThreshold:
+            return False
+        widths = self.prefixWidths(canvas, w, h, maxw)
+        if widths is None:
+            pos, fits = self._wrapByWords(canvas, w, h, maxw)
+            return not fits or pos < len(self.text)
+        # Allow for rounding differences from ReportLab's stringWidth()
+        return widths[-1] - maxw > self.tolerance
+
+    def _fits(self, canvas, w, h, maxw, pos):
+        return self.size(canvas, w, h, self.text[:pos])[0] <= maxw
+
+    def _nextWrapPosition(self, pos):
+        m = _wrap_position_rx.search(self.text, pos + 1)
+        return m.start() if m else len(self.text)
+
+    def _findWrapPosition(self, canvas, w, h, maxw, widths):
+        """Find where to wrap the text using precomputed prefix widths.
+
+        Returns (pos, fits), or None if the prefix widths disagree with
+        the real measurements.
+        """
+        # The longest prefix that fits
+        end = bisect.bisect_right(widths, maxw) - 1
+        pos = None
+        for m in _wrap_position_rx.finditer(self.text, 0, end + 1):
+            pos = m.start()
+        if end == len(self.text):
+            pos = end
+        if pos is None:
             # well, it still sticks out, but a bit less
+            pos = self._nextWrapPosition(0)
+            if self._fits(canvas, w, h, maxw, pos):
+                return None
+            return pos, False
+        # Double-check with the real measurements, in case rounding
+        # errors put us on the wrong side of maxw
+        if not self._fits(canvas, w, h, maxw, pos):
+            return None
+        if pos < len(self.text) and self._fits(canvas, w, h, maxw,
+                                               self._nextWrapPosition(pos)):
+            return None
+        return pos, True
+
+    def _wrapByWords(self, canvas, w, h, maxw):
+        """Find where to wrap the text by measuring it one word at a time.
+
+        Keeps a running sum of word widths and stops at the first word
+        that doesn't fit, so wrapping a long paragraph takes time
+        proportional to its length.  This works with any font.
+
+        Returns (pos, fits), where pos is the longest prefix that fits,
+        or, if not even the first word fits, the end of the first word.
+        """
+        fontSize, leading, tabsize = self._calcSizes(w, h)
+        candidates = itertools.chain(
+            (m.start() for m in _wrap_position_rx.finditer(self.text)),
+            [len(self.text)])
+        fitting = []
+        textwidth = 0
+        start = 0
+        pos = None
+        for pos in candidates:
+            for run in self._splitIntoRuns(self.text[start:pos]):
+                if run == '\t':
+                    textwidth = textwidth + tabsize - textwidth % tabsize
+                elif run:
+                    textwidth += canvas.stringWidth(run, self.font, fontSize)
+            start = pos
+            if textwidth > maxw:
+                break
+            fitting.append(pos)
+            pos = None
+        # The sum of the word widths can differ from the width of the
+        # whole prefix by rounding errors, so double-check with the real
+        # measurements
+        while fitting and not self._fits(canvas, w, h, maxw, fitting[-1]):
+            pos = fitting.pop()
+        while pos is not None and self._fits(canvas, w, h, maxw, pos):
+            fitting.append(pos)
+            pos = next(candidates, None)
+        if fitting:
+            return fitting[-1], True
+        return pos, False
+
+    def split(self, canvas, w, h, maxw):
+        found = None
+        if len(self.text) >= self.bulkMeasureThreshold:
+            widths = self.prefixWidths(canvas, w, h, maxw)
+            if widths is not None:
+                found = self._findWrapPosition(canvas, w, h, maxw, widths)
+        if found is not None:
+            pos, fits = found
+        else:
+            pos, fits = self._wrapByWords(canvas, w, h, maxw)
+        if fits or pos < len(self.text):
+            # if it doesn't fit, well, it still sticks out, but a bit less
             return [self.cloneStyle(self.text[:pos]),
                     self.cloneStyle(self.text[pos:].lstrip())]
         return [self]
@@ -582,21 +1159,53 @@ class TextChunk(object):
     def __str__(self):
         return self.text
 
+    def cacheKey(self):
+        return (self.__class__.__name__, self.text, self.font, self.fontSize,
+                self.vgap, self.color.hexval())
+
+
+_arg_split_rx = re.compile('(?:[^ "]|"[^"]*")+')
+_directive_token_rx = re.compile('((?:[^ ,"]|"[^"]*")+)|,')
+
 
 class Presentation(object):
     """Presentation."""
 
     pageSize = landscape(Screen_1024x768_at_72_dpi)
 
-    def __init__(self, file=None, title=None, unsafe=False):
+    # Maximum number of %filter commands to run at the same time (None
+    # means the ThreadPoolExecutor default)
+    filterThreads = None
+
+    # Maximum number of lines of %filter output to buffer per filter before
+    # the filter command is paused until the parser catches up
+    filterQueueSize = 1000
+
+    def __init__(self, file=None, title=None, unsafe=False, cache_dir=None,
+                 max_image_dpi=None, font_index=None, cache_filters=False,
+                 filter_timeout=None, filter_max_output=None,
+                 filter_workers=()):
         self.defaultDirectives = {}
+        self._defaultPrograms = {}
         self.tabDirectives = {}
-        self.fonts = Fonts()
+        self.fonts = Fonts(cache_dir, font_index)
         self.slides = []
         self._directives_used_in_this_line = set()
         self.title = title
         self.unsafe = unsafe
+        self.cache_dir = cache_dir
+        self.cache_filters = cache_filters and bool(cache_dir)
+        self.filter_timeout = filter_timeout
+        self.filter_max_output = filter_max_output
+        self.filter_workers = set(filter_workers)
+        self._filterWorkers = {}
+        self._filterChildren = set()
+        self._filterWorkersLock = threading.Lock()
+        self.max_image_dpi = max_image_dpi
         self.basedir = ''
+        self.inputFiles = set()
+        self.sourceFiles = set()
+        self._parseCacheable = True
         self.lineno = None
         if file:
             self.load(file)
@@ -605,21 +1214,89 @@ class Presentation(object):
         """Parse an .mgp file.
 
         ``file`` can be a filename or a file-like object.
+
+        If ``self.cache_dir`` is set and ``file`` is a filename, the parsed
+        presentation is cached on disk and reused until any of the source
+        files change (see ``ParseCache``).
+        """
+        cache = None
+        if self.cache_dir and not hasattr(file, 'read'):
+            cache = ParseCache(os.path.join(self.cache_dir, 'parsed'))
+            key = cache.key(file, basedir, self.unsafe)
+            state = cache.load(key)
+            if state is not None:
+                self._restoreParsed(file, basedir, state)
+                return
+        for slide in self.iterSlides(file, basedir):
+            pass
+        if cache is not None and self._parseCacheable:
+            cache.store(key, self._parsedState())
+
+    def _parsedState(self):
+        """Return the result of parsing, for ParseCache."""
+        return dict(
+            slides=self.slides,
+            fonts=self.fonts.definitions,
+            inputFiles=sorted(self.inputFiles),
+            sourceFiles=sorted(self.sourceFiles),
+            defaultDirectives=self.defaultDirectives,
+            tabDirectives=self.tabDirectives,
+        )
+
+    def _restoreParsed(self, file, basedir, state):
+        """Restore the result of parsing from ParseCache."""
+        self.basedir = basedir or os.path.dirname(file)
+        for definition in state['fonts']:
+            self.fonts.define(*definition)
+        self.slides = state['slides']
+        self.inputFiles.update(state['inputFiles'])
+        self.sourceFiles.update(state['sourceFiles'])
+        self.defaultDirectives = state['defaultDirectives']
+        self._defaultPrograms = {
+            lineno: self._compileDirectives(directives)
+            for lineno, directives in self.defaultDirectives.items()}
+        self.tabDirectives = state['tabDirectives']
+
+    def iterSlides(self, file, basedir='', keep=True):
+        """Parse an .mgp file, yielding each slide as soon as it's complete.
+
+        ``file`` can be a filename or a file-like object.
+
+        A slide is complete when the next %page directive (or the end of
+        the file) is reached.  If ``keep`` is False, slides are removed
+        from ``self.slides`` after they're yielded, so memory use does not
+        grow with the length of the presentation.
         """
         self.basedir = basedir
         if not hasattr(file, 'read'):
             if not self.basedir:
                 self.basedir = os.path.dirname(file)
+            self.inputFiles.add(file)
+            self.sourceFiles.add(file)
             file = open(file)
-        for lineno, line in self.preprocess(file):
-            self.lineno = lineno
-            if line.startswith(('#', '%%')):
-                pass
-            elif line.startswith('%'):
-                self._handleDirectives(line)
-            else:
-                self._handleText(line)
+        done = 0
+        try:
+            for lineno, line in self.preprocess(file):
+                self.lineno = lineno
+                if line.startswith(('#', '%%')):
+                    pass
+                elif line.startswith('%'):
+                    self._handleDirectives(line)
+                else:
+                    self._handleText(line)
+                while len(self.slides) > done + 1:
+                    yield self.slides[done]
+                    if keep:
+                        done += 1
+                    else:
+                        del self.slides[done]
+        finally:
+            self.closeFilterWorkers()
         self.lineno = None
+        for slide in self.slides[done:]:
+            yield slide
+        if not keep:
+            del self.slides[done:]
 
     def preprocess(self, file):
         """Handle %filter directives in the source file.
@@ -634,75 +1311,315 @@ class Presentation(object):
         is True) OR emits a warning and replaces the text with an error
         message (if self.unsafe is False).
 
+        All the filters of a file are started up front and run
+        concurrently (see ``filterThreads``), but their output is yielded
+        in source order.  At most ``filterQueueSize`` lines of output are
+        buffered for each filter; the rest waits in the pipe, so a filter
+        that gets ahead of the parser is paused instead of being read into
+        memory.  If the caller stops early (e.g. because of an error), the
+        filters that are still running are killed.
+
         Can raise MgpSyntaxError if the directives are unbalanced or
         ill-formed.
         """
+        executor = concurrent.futures.ThreadPoolExecutor(self.filterThreads)
+        stopped = threading.Event()
+        items = []
+        finished = False
+        try:
+            items = self._scanFilters(file, executor, stopped)
+            for kind, lineno, value in items:
+                if kind == 'line':
+                    yield lineno, value
+                elif kind == 'filter' and self.unsafe:
+                    if not self.cache_filters:
+                        # The output can be different next time
+                        self._parseCacheable = False
+                    output, future = value
+                    for line in iter(output.get, None):
+                        yield lineno, line
+                    if future.result() != 0:
+                        # Don't cache the output of a failed command
+                        self._parseCacheable = False
+                elif kind == 'filter':
+                    log.warning("Ignoring %filter directive on line {0} in safe mode".format(lineno))
+                    yield lineno, 'Filtering through "%s" disabled, use --unsafe to enable\n' % value
+                elif kind == 'include':
+                    self.inputFiles.add(value)
+                    self.sourceFiles.add(value)
+                    with open(value) as f:
+                        # basedir handling for nested includes might be wrong
+                        # (does mgp even allow nested includes?)
+                        for n, line in self.preprocess(f):
+                            # Line numbers: do we report the correct
+                            # linenumber for the wrong filename?  Or the line
+                            # number of the %include directive? in the right file?
+                            yield lineno, line
+                else:
+                    raise value
+            finished = True
+        except FilterError:
+            # Blame the %filter (or %include) directive, not the last line
+            # that was parsed before the error
+            self.lineno = lineno
+            raise
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            if not finished:
+                self._stopFilters(items, stopped)
+
+    def _stopFilters(self, items, stopped):
+        """Stop the filters started by _scanFilters() early.
+
+        Kills the filter commands that are still running, and unblocks the
+        threads waiting for their output to be read.
+        """
+        stopped.set()
+        with self._filterWorkersLock:
+            children = list(self._filterChildren)
+        for child in children:
+            _killProcessGroup(child)
+        for kind, lineno, value in items:
+            if kind == 'filter' and self.unsafe:
+                output, future = value
+                with contextlib.suppress(queue.Empty):
+                    while True:
+                        output.get_nowait()
+
+    def _scanFilters(self, file, executor, stopped):
+        """Find the %filter and %include directives in the source file.
+
+        Starts the filters (in unsafe mode) in ``executor``.  Once the
+        ``stopped`` event is set, their output is discarded and any commands
+        still running are killed.
+
+        Returns a list of (kind, lineno, value), where kind is one of
+
+        - 'line': value is a line of text
+        - 'filter': value is a (queue, future) tuple, where the queue
+          receives lines of the filter output followed by None, and the
+          future completes when the filter is done (or, in safe mode,
+          value is the filter command)
+        - 'include': value is the name of the included file
+        - 'error': value is a MgpSyntaxError; this is always the last item
+
+        Syntax errors are not raised immediately, so that the lines before
+        them are processed as usual.
+        """
+        items = []
         filter_cmd = None
         filter_lineno = None
         data_to_filter = []
-        for lineno, line in enumerate(file, 1):
-            if line.startswith('%filter'):
-                if filter_cmd is not None:
-                    raise MgpSyntaxError(
-                        'Cannot nest %filter directives (line {0}, previous'
-                        ' %filter on line {1}), did you forget %endfilter?'
-                        .format(lineno, filter_lineno))
-                filter_cmd = line[len('%filter'):].strip()
-                if not filter_cmd.startswith('"') or not filter_cmd.endswith('"'):
-                    raise MgpSyntaxError("%filter directive expects a quoted string")
-                filter_cmd = filter_cmd[1:-1]
-                filter_lineno = lineno
-                data_to_filter = []
-            elif line.startswith('%endfilter'):
-                if not filter_cmd:
-                    raise MgpSyntaxError('%endfilter on line {0} without matching %filter'.format(lineno))
-                if self.unsafe:
-                    child = subprocess.Popen(filter_cmd, shell=True,
-                                             cwd=self.basedir,
-                                             stdin=subprocess.PIPE,
-                                             stdout=subprocess.PIPE)
-                    stdin = ''.join(data_to_filter)
-                    stdin = stdin.encode('UTF-8')
-                    output = child.communicate(stdin)[0]
-                    output = output.decode('UTF-8')
+        try:
+            for lineno, line in enumerate(file, 1):
+                if line.startswith('%filter'):
+                    if filter_cmd is not None:
+                        raise MgpSyntaxError(
+                            'Cannot nest %filter directives (line {0}, previous'
+                            ' %filter on line {1}), did you forget %endfilter?'
+                            .format(lineno, filter_lineno))
+                    filter_cmd = line[len('%filter'):].strip()
+                    if not filter_cmd.startswith('"') or not filter_cmd.endswith('"'):
+                        raise MgpSyntaxError("%filter directive expects a quoted string")
+                    filter_cmd = filter_cmd[1:-1]
+                    filter_lineno = lineno
+                    data_to_filter = []
+                elif line.startswith('%endfilter'):
+                    if not filter_cmd:
+                        raise MgpSyntaxError('%endfilter on line {0} without matching %filter'.format(lineno))
+                    if self.unsafe:
+                        output = queue.Queue(self.filterQueueSize)
+                        value = (output, executor.submit(
+                            self._runFilter, filter_cmd, data_to_filter,
+                            self._emitter(output, stopped)))
+                    else:
+                        value = filter_cmd
+                    items.append(('filter', filter_lineno, value))
+                    filter_cmd = None
+                elif filter_cmd:
+                    data_to_filter.append(line)
+                elif line.startswith('%include'):
+                    # %include is valid only in the preamble, perhaps we
+                    # should watch for %page directives?
+                    filename = line[len('%include'):].strip()
+                    if not filename.startswith('"') or not filename.endswith('"'):
+                        raise MgpSyntaxError("%include directive expects a quoted string")
+                    filename = os.path.join(self.basedir, filename[1:-1])
+                    items.append(('include', lineno, filename))
                 else:
-                    log.warning("Ignoring %filter directive on line {0} in safe mode".format(filter_lineno))
-                    output = 'Filtering through "%s" disabled, use --unsafe to enable\n' % filter_cmd
-                for line in output.splitlines(True):
-                    yield filter_lineno, line
-                filter_cmd = None
-            elif filter_cmd:
-                data_to_filter.append(line)
-            elif line.startswith('%include'):
-                # %include is valid only in the preamble, perhaps we
-                # should watch for %page directives?
-                filename = line[len('%include'):].strip()
-                if not filename.startswith('"') or not filename.endswith('"'):
-                    raise MgpSyntaxError("%include directive expects a quoted string")
-                filename = os.path.join(self.basedir, filename[1:-1])
-                with open(filename) as f:
-                    # basedir handling for nested includes might be wrong
-                    # (does mgp even allow nested includes?)
-                    for n, line in self.preprocess(f):
-                        # Line numbers: do we report the correct
-                        # linenumber for the wrong filename?  Or the line
-                        # number of the %include directive? in the right file?
-                        yield lineno, line
+                    items.append(('line', lineno, line))
+            if filter_cmd is not None:
+                raise MgpSyntaxError(
+                    'Missing %endfilter at end of file (%filter on line {0})'
+                    .format(filter_lineno))
+        except MgpSyntaxError as e:
+            items.append(('error', None, e))
+        return items
+
+    @staticmethod
+    def _emitter(output, stopped):
+        """Return an emit() function for _runFilter() that feeds a queue.
+
+        The function blocks while the queue is full, and raises
+        _FilterCancelled once ``stopped`` is set.
+        """
+        def emit(line):
+            if stopped.is_set():
+                raise _FilterCancelled()
+            output.put(line)
+        return emit
+
+    def _runFilter(self, command, lines, emit):
+        """Pipe lines of text through an external command.
+
+        The input is written to the command incrementally, and each line
+        of the output is passed to ``emit()`` as soon as it's read.
+        ``emit(None)`` is called at the end, even if the command fails.
+
+        Returns the exit status of the command.
+
+        Raises FilterError if the command runs for longer than
+        ``self.filter_timeout`` seconds (not counting the time ``emit()``
+        blocks waiting for the parser) or produces more than
+        ``self.filter_max_output`` bytes of output.
+
+        If ``self.cache_filters`` is set, the output is cached on disk
+        (see ``FilterCache``) and the command is not run again for the
+        same text.  Only then is a copy of the whole output kept in memory.
+        """
+        try:
+            cache = key = None
+            if self.cache_filters:
+                cache = FilterCache(os.path.join(self.cache_dir, 'filters'))
+                key = cache.key(command, ''.join(lines), self.basedir)
+                output = cache.get(key)
+                if output is not None:
+                    log.debug("Reusing cached output of %s", command)
+                    for line in output.splitlines(True):
+                        emit(line)
+                    return 0
+            output = [] if cache is not None else None
+            if command in self.filter_workers:
+                returncode = self._runFilterWorker(command, lines, emit,
+                                                   output)
             else:
-                yield lineno, line
-        if filter_cmd is not None:
-            raise MgpSyntaxError(
-                'Missing %endfilter at end of file (%filter on line {0})'
-                .format(filter_lineno))
+                returncode = self._pipe(command, lines, emit, output)
+            if cache is not None and returncode == 0:
+                cache.store(key, ''.join(output))
+            return returncode
+        finally:
+            emit(None)
+
+    def _runFilterWorker(self, command, lines, emit, output=None):
+        """Send lines of text to a FilterWorker for _runFilter().
+
+        Starts the worker on first use.  Appends the output lines to
+        ``output``, if it's a list.
+
+        Returns 0.
+        """
+        with self._filterWorkersLock:
+            worker = self._filterWorkers.get(command)
+            if worker is None:
+                worker = self._filterWorkers[command] = FilterWorker(
+                    command, cwd=self.basedir or None)
+        result = worker.run(''.join(lines), timeout=self.filter_timeout,
+                            max_output=self.filter_max_output)
+        for line in result.splitlines(True):
+            if output is not None:
+                output.append(line)
+            emit(line)
+        return 0
+
+    def closeFilterWorkers(self):
+        """Stop all the FilterWorker processes started by this presentation."""
+        with self._filterWorkersLock:
+            workers = list(self._filterWorkers.values())
+            self._filterWorkers.clear()
+        for worker in workers:
+            worker.close()
 
     @staticmethod
-    def _splitDirectives(line):
+    def _pausingEmitter(emit, timer):
+        """Wrap emit() so the time it blocks doesn't count towards a timeout.
+
+        A filter that is paused because the parser hasn't caught up with its
+        output yet is not running slow.
         """
-            >>> Presentation._splitDirectives('foo, bar 42, baz "q, q", wumba')
-            ['foo', 'bar 42', 'baz "q, q"', 'wumba']
+        def pausingEmit(line):
+            timer.pause()
+            try:
+                emit(line)
+            finally:
+                timer.resume()
+        return pausingEmit
 
+    def _pipe(self, command, lines, emit, output=None):
+        """Run an external command for _runFilter().
+
+        Appends the output lines to ``output``, if it's a list.
+
+        Returns the exit status of the command.
         """
-        return [s.strip() for s in re.findall('(?:[^,"]|"[^"]*")+', line)]
+        child = subprocess.Popen(command, shell=True,
+                                 cwd=self.basedir or None,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 start_new_session=True)
+        with self._filterWorkersLock:
+            self._filterChildren.add(child)
+
+        def write_input():
+            try:
+                for line in lines:
+                    child.stdin.write(line.encode('UTF-8'))
+                child.stdin.close()
+            except OSError:
+                # the command exited without reading all of its input
+                pass
+
+        timed_out = []
+
+        def kill():
+            timed_out.append(True)
+            _killProcessGroup(child)
+
+        writer = threading.Thread(target=write_input, daemon=True)
+        writer.start()
+        timer = None
+        if self.filter_timeout:
+            timer = _PausableTimer(self.filter_timeout, kill)
+            timer.start()
+            emit = self._pausingEmitter(emit, timer)
+        size = 0
+        try:
+            for raw in child.stdout:
+                size += len(raw)
+                if self.filter_max_output and size > self.filter_max_output:
+                    _killProcessGroup(child)
+                    raise FilterError(
+                        '%filter command "{0}" produced more than {1} bytes'
+                        ' of output'.format(command, self.filter_max_output))
+                for line in raw.decode('UTF-8').splitlines(True):
+                    if output is not None:
+                        output.append(line)
+                    emit(line)
+            if timed_out:
+                raise FilterError(
+                    '%filter command "{0}" did not finish in {1} seconds'
+                    .format(command, self.filter_timeout))
+        except _FilterCancelled:
+            _killProcessGroup(child)
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+            child.stdout.close()
+            returncode = child.wait()
+            writer.join()
+            with self._filterWorkersLock:
+                self._filterChildren.discard(child)
+        return returncode
 
     @staticmethod
     def _splitArgs(line):
@@ -711,7 +1628,50 @@ class Presentation(object):
             ['baz', '42', '"q w"', 'e', '-foo', '11']
 
         """
-        return [s.strip() for s in re.findall('(?:[^ "]|"[^"]*")+', line)]
+        return [s.strip() for s in _arg_split_rx.findall(line)]
+
+    @staticmethod
+    def _lexDirectives(line):
+        """Split a directive line into directives and their arguments.
+
+        Directives are separated by commas and arguments by spaces, except
+        within double quotes.  Both are split in a single pass.
+
+            >>> Presentation._lexDirectives('foo, bar 42, baz "q, q" e, ,')
+            [['foo'], ['bar', '42'], ['baz', '"q, q"', 'e'], [], []]
+
+        """
+        directives = [[]]
+        for token in _directive_token_rx.findall(line):
+            if token:
+                directives[-1].append(token.strip())
+            else:
+                directives.append([])
+        return directives
+
+    _directiveHandlers = {}
+    _specialDirectiveHandlers = {}
+
+    @classmethod
+    def _buildDispatchTables(cls):
+        """Map directive names to handler methods.
+
+        Looking up ``_handleDirective_<name>`` with getattr() for every
+        directive is slow, so it's done once per class.
+        """
+        cls._directiveHandlers = {}
+        cls._specialDirectiveHandlers = {}
+        for name in dir(cls):
+            if name.startswith('_handleDirective_'):
+                word = name[len('_handleDirective_'):]
+                cls._directiveHandlers[word] = getattr(cls, name)
+            elif name.startswith('_handleSpecialDirective_'):
+                word = name[len('_handleSpecialDirective_'):]
+                cls._specialDirectiveHandlers[word] = getattr(cls, name)
+
+    def __init_subclass__(cls, **kw):
+        super().__init_subclass__(**kw)
+        cls._buildDispatchTables()
 
     def _handleDirectives(self, line):
         """Handle a directive line
@@ -719,18 +1679,19 @@ class Presentation(object):
         The line starts with '%' and contains a number of comma-separated
         MagicPoint directives with arguments.
         """
-        line = line[1:].strip()
-        parts = self._splitDirectives(line)
-        args = self._splitArgs(parts[0])
-        word = args[0]
-        handler = getattr(self, '_handleSpecialDirective_%s' % word, None)
+        directives = self._lexDirectives(line[1:].strip())
+        args = directives[0]
+        handler = None
+        if args:
+            handler = self._specialDirectiveHandlers.get(args[0])
         if handler is not None:
             # Special directives that take <list-of-directives> as arguments
-            parts = [p for p in args[:2] + [' '.join(args[2:])] + parts[1:] if p]
-            handler(parts)
+            parts = [p for p in args[:2] + [' '.join(args[2:])] +
+                     [' '.join(d) for d in directives[1:]] if p]
+            handler(self, parts)
         else:
-            for part in parts:
-                self._handleDirective(part.strip())
+            for args in directives:
+                self._handleDirective(args)
 
     def _handleSpecialDirective_default(self, parts):
         """Handle %default <linenum> <list-of-directives>."""
@@ -738,6 +1699,41 @@ class Presentation(object):
             raise MgpSyntaxError("%default must be used in the preamble")
         lineno, = self._parseArgs(parts[:2], "n")
         self.defaultDirectives[lineno] = parts[2:]
+        self._defaultPrograms[lineno] = self._compileDirectives(parts[2:])
+
+    def _compileDirectives(self, directives):
+        """Prepare a list of directives for repeated application.
+
+        ``directives`` is a list of strings, as in ``%default``.
+
+        Returns a tuple of (word, args, handler) tuples, where ``handler``
+        is an unbound method (or None for unknown directives).  See
+        ``_runDirectives()``.
+        """
+        program = []
+        for directive in directives:
+            args = self._splitArgs(directive)
+            if args:
+                word = args[0]
+                program.append((word, args, self._directiveHandlers.get(word)))
+        return tuple(program)
+
+    def _runDirectives(self, program):
+        """Apply directives compiled by ``_compileDirectives()``.
+
+        Directives that were already used in this line are skipped, so
+        explicit directives override the defaults.
+        """
+        for word, args, handler in program:
+            # NB: handlers like %again start a new line, which resets
+            # _directives_used_in_this_line
+            if word in self._directives_used_in_this_line:
+                continue
+            self._directives_used_in_this_line.add(word)
+            if handler is None:
+                self._handleUnknownDirective(args)
+            else:
+                handler(self, args)
 
     def _handleSpecialDirective_tab(self, parts):
         """Handle %tab <tabnum> <list-of-directives>."""
@@ -760,9 +1756,8 @@ class Presentation(object):
             enginefont, = self._parseArgs(args, "s")
             self.fonts.define(name, engine, enginefont)
 
-    def _handleDirective(self, directive):
-        """Handle a single directive with arguments."""
-        parts = self._splitArgs(directive)
+    def _handleDirective(self, parts):
+        """Handle a single directive, split into arguments."""
         if not parts:
             # Huh, an empty directive.  We end up here if we encounter
             # something like "%foo, , bar".  This should probably abort
@@ -771,9 +1766,11 @@ class Presentation(object):
             return
         word = parts[0]
         self._directives_used_in_this_line.add(word)
-        handler = getattr(self, '_handleDirective_%s' % word,
-                          self._handleUnknownDirective)
-        handler(parts)
+        handler = self._directiveHandlers.get(word)
+        if handler is None:
+            self._handleUnknownDirective(parts)
+        else:
+            handler(self, parts)
 
     def inPreamble(self):
         """Are we still in the preamble?
@@ -925,6 +1922,7 @@ class Presentation(object):
             else:
                 raise MgpSyntaxError("newimage %s not handled yet" % k)
         filename = os.path.join(self.basedir, args[-1])
+        self.inputFiles.add(filename)
         self.slides[-1].addImage(filename, zoom, raised_by)
 
     def _handleDirective_mark(self, parts):
@@ -1018,16 +2016,22 @@ class Presentation(object):
             raise MgpSyntaxError('No text allowed in the preamble')
         if not self._continuing:
             self._lastlineno += 1
-            if self._use_defaults:
-                for part in self.defaultDirectives.get(self._lastlineno, []):
-                    word = self._splitArgs(part)[0]
-                    if word not in self._directives_used_in_this_line:
-                        self._handleDirective(part)
+            program = self._defaultPrograms.get(self._lastlineno)
+            if program and self._use_defaults:
+                self._runDirectives(program)
         line = line.rstrip('\n').replace(r'\#', '#').replace(r'\\', '\\')
         self.slides[-1].addText(line)
         self._continuing = False
         self._directives_used_in_this_line = set()
 
+    def dependencies(self):
+        """Return the set of files this presentation depends on.
+
+        This includes the .mgp file itself, any %include'd files, images
+        and font files.
+        """
+        return self.inputFiles | set(self.fonts.files.values())
+
     def __str__(self):
         """Represent the contents of the presentation as text."""
         res = []
@@ -1036,20 +2040,838 @@ class Presentation(object):
             res.append(str(s) + '\n')
         return ''.join(res)
 
-    def makePDF(self, outfile):
+    def layOut(self, jobs=1):
+        """Perform word-wrapping of all slides using ``jobs`` processes.
+
+        Parsing has to be done serially (since directives carry state from
+        one page to the next), but the layout of each slide is independent
+        of the others.  The slides are sent off to worker processes in
+        batches and replaced with the word-wrapped copies that come back.
+
+        Slides that are already word-wrapped are left alone.
+        """
+        todo = [n for n, s in enumerate(self.slides) if not s.wrapped]
+        if not todo:
+            return
+        batch_size = -(-len(todo) // (jobs * 4))
+        batches = [todo[i:i + batch_size]
+                   for i in range(0, len(todo), batch_size)]
+        with concurrent.futures.ProcessPoolExecutor(
+                jobs, initializer=_initLayoutWorker,
+                initargs=(self.fonts.files,)) as pool:
+            results = pool.map(
+                _layOutSlides,
+                [[self.slides[n] for n in batch] for batch in batches],
+                itertools.repeat(self.pageSize))
+            for batch, slides in zip(batches, results):
+                for n, slide in zip(batch, slides):
+                    self.slides[n] = slide
+
+    def makePDF(self, outfile, jobs=1):
         """Render the presentation into a PDF.
 
         ``outfile`` can be a filename or a file-like object.
+
+        ``jobs`` is the number of processes to use for laying out the
+        slides; see ``layOut()``.
+
+        If ``self.cache_dir`` is set, slide layouts are cached on disk,
+        and slides that haven't changed since the last time are not
+        word-wrapped again.
+        """
+        cache = None
+        if self.cache_dir:
+            cache = LayoutCache(os.path.join(self.cache_dir, 'layout'))
+            keys = [cache.key(s, self.pageSize, self.fonts.files)
+                    for s in self.slides]
+            reused = cache.restore(self.slides, keys)
+        if jobs > 1:
+            self.layOut(jobs)
+        canvas = self._startPDF(outfile)
+        try:
+            if cache is not None:
+                for n, s in enumerate(self.slides):
+                    if n not in reused:
+                        s.layOut(canvas, self.pageSize)
+                        cache.store(s, keys[n])
+                log.debug("Layout cache: %d slides reused, %d laid out",
+                          len(reused), len(self.slides) - len(reused))
+            for n, s in enumerate(self.slides):
+                s.drawOn(canvas, self.pageSize)
+                canvas.showPage()
+            self._finishPDF(canvas)
+        finally:
+            canvas.cleanUp()
+
+    def streamPDF(self, file, outfile, basedir=''):
+        """Parse an .mgp file and render it into a PDF, one slide at a time.
+
+        ``file`` can be a filename or a file-like object, ``outfile`` can
+        be a filename or a file-like object.
+
+        Unlike ``load()`` followed by ``makePDF()``, this draws each slide
+        as soon as it has been parsed, and then forgets it, so the parsed
+        presentation is never held in memory in full.  (The source text
+        is still read up front, see ``preprocess()``, and ReportLab keeps
+        the compressed page contents until the PDF is saved.)
+
+        Slides are laid out in this process, one by one.  If
+        ``self.cache_dir`` is set, slide layouts are cached on disk, like
+        in ``makePDF()``.
         """
-        canvas = Canvas(outfile, self.pageSize)
+        cache = None
+        if self.cache_dir:
+            cache = LayoutCache(os.path.join(self.cache_dir, 'layout'))
+        canvas = None
+        reused = laidOut = 0
+        try:
+            with contextlib.closing(self.iterSlides(file, basedir,
+                                                    keep=False)) as slides:
+                for s in slides:
+                    if canvas is None:
+                        canvas = self._startPDF(outfile)
+                    lineno, self.lineno = self.lineno, None
+                    if cache is not None:
+                        key = cache.key(s, self.pageSize, self.fonts.files)
+                        if cache.restore([s], [key]):
+                            reused += 1
+                        else:
+                            s.layOut(canvas, self.pageSize)
+                            cache.store(s, key)
+                            laidOut += 1
+                    s.drawOn(canvas, self.pageSize)
+                    canvas.showPage()
+                    self.lineno = lineno
+            if canvas is None:
+                canvas = self._startPDF(outfile)
+            if cache is not None:
+                log.debug("Layout cache: %d slides reused, %d laid out",
+                          reused, laidOut)
+            self._finishPDF(canvas)
+        finally:
+            if canvas is not None:
+                canvas.cleanUp()
+
+    def _startPDF(self, outfile):
+        """Create a PresentationCanvas for makePDF() or streamPDF()."""
+        image_cache_dir = None
+        if self.cache_dir:
+            image_cache_dir = os.path.join(self.cache_dir, 'images')
+        canvas = PresentationCanvas(outfile, self.pageSize,
+                                    maxImageDPI=self.max_image_dpi,
+                                    imageCacheDir=image_cache_dir)
         if self.title:
             canvas.setTitle(self.title)
         # canvas.setAuthor(...)
         # canvas.setSubject(...)
-        for n, s in enumerate(self.slides):
-            s.drawOn(canvas, self.pageSize)
-            canvas.showPage()
+        return canvas
+
+    def _finishPDF(self, canvas):
+        """Save the PDF and log some statistics."""
         canvas.save()
+        stats = canvas.widthCacheInfo()
+        log.debug("Text width cache: %d hits, %d misses",
+                  stats.hits, stats.misses)
+        log.debug("Images: %d embedded, %d referenced",
+                  canvas.imagesEmbedded, canvas.imagesReferenced)
+        log.debug("Fonts: %d parsed, %d reused (%.3fs saved)",
+                  self.fonts.parsed, self.fonts.reused,
+                  self.fonts.parseTimeSaved)
+
+
+Presentation._buildDispatchTables()
+
+
+class FilterWorker(object):
+    """A long-running %filter command.
+
+    Starting a process for every %filter block is slow when the filter is,
+    e.g., a Python script.  Commands listed with --filter-worker are
+    started once, with MGP2PDF_FILTER_WORKER=1 in the environment, and
+    are sent all the blocks one after another, using this protocol:
+
+    - mgp2pdf writes the size of the input text in bytes, as a decimal
+      number on a line by itself, followed by the text (in UTF-8);
+    - the worker replies in the same format with the output text.
+
+    The worker should exit when its stdin is closed.  Blocks from
+    different threads are handled one at a time.
+    """
+
+    def __init__(self, command, cwd=None):
+        self.command = command
+        self.cwd = cwd
+        self.child = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the worker process."""
+        log.debug("Starting filter worker %s", self.command)
+        env = dict(os.environ, MGP2PDF_FILTER_WORKER='1')
+        self.child = subprocess.Popen(self.command, shell=True, cwd=self.cwd,
+                                      env=env, stdin=subprocess.PIPE,
+                                      stdout=subprocess.PIPE,
+                                      start_new_session=True)
+
+    def run(self, text, timeout=None, max_output=None):
+        """Filter text through the worker.
+
+        Starts the worker if it's not running.
+
+        Raises FilterError if the worker doesn't reply in ``timeout``
+        seconds, replies with more than ``max_output`` bytes, or violates
+        the protocol.  The worker is stopped in that case, and will be
+        started again for the next block.
+        """
+        with self.lock:
+            if self.child is None:
+                self.start()
+            timed_out = []
+            child = self.child
+
+            def kill():
+                timed_out.append(True)
+                _killProcessGroup(child)
+
+            timer = None
+            if timeout:
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+            try:
+                return self._communicate(text, max_output)
+            except (OSError, ValueError, FilterError) as e:
+                self._kill()
+                if timed_out:
+                    raise FilterError(
+                        '%filter worker "{0}" did not reply in {1} seconds'
+                        .format(self.command, timeout))
+                if isinstance(e, FilterError):
+                    raise
+                raise FilterError('%filter worker "{0}" failed: {1}'.format(
+                    self.command, e))
+            finally:
+                if timer is not None:
+                    timer.cancel()
+
+    def _communicate(self, text, max_output):
+        data = text.encode('UTF-8')
+        self.child.stdin.write(b'%d\n' % len(data))
+        self.child.stdin.write(data)
+        self.child.stdin.flush()
+        header = self.child.stdout.readline()
+        if not header:
+            raise FilterError('%filter worker "{0}" exited unexpectedly'
+                              .format(self.command))
+        size = int(header)
+        if max_output and size > max_output:
+            raise FilterError(
+                '%filter worker "{0}" produced more than {1} bytes'
+                ' of output'.format(self.command, max_output))
+        output = self.child.stdout.read(size)
+        if len(output) < size:
+            raise FilterError('%filter worker "{0}" exited unexpectedly'
+                              .format(self.command))
+        return output.decode('UTF-8')
+
+    def _kill(self):
+        _killProcessGroup(self.child)
+        self.close()
+
+    def close(self):
+        """Stop the worker process."""
+        if self.child is None:
+            return
+        child, self.child = self.child, None
+        with contextlib.suppress(OSError):
+            child.stdin.close()
+        child.stdout.close()
+        child.wait()
+
+
+class _PausableTimer(object):
+    """Call a function after a number of seconds, not counting pauses.
+
+    Like ``threading.Timer``, but the time between ``pause()`` and
+    ``resume()`` doesn't count towards the interval.
+    """
+
+    def __init__(self, interval, function):
+        self.interval = interval
+        self.function = function
+        self._condition = threading.Condition()
+        self._deadline = None
+        self._pausedAt = None
+        self._cancelled = False
+
+    def start(self):
+        self._deadline = time.monotonic() + self.interval
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if self._cancelled:
+                    return
+                if self._pausedAt is not None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        self.function()
+
+    def pause(self):
+        with self._condition:
+            self._pausedAt = time.monotonic()
+
+    def resume(self):
+        with self._condition:
+            self._deadline += time.monotonic() - self._pausedAt
+            self._pausedAt = None
+            self._condition.notify()
+
+    def cancel(self):
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify()
+
+
+def _killProcessGroup(child):
+    """Kill a child process started with start_new_session=True.
+
+    This also kills any processes it started (e.g. when it's a shell).
+    """
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(child.pid, signal.SIGKILL)
+        else:  # pragma: nocover
+            child.kill()
+    except OSError:
+        # already gone
+        pass
+
+
+def fileStamp(filename):
+    """Return something that changes when a file is modified.
+
+    Returns None if the file doesn't exist.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+@functools.lru_cache(maxsize=None)
+def sourceHash():
+    """Return a hash of the mgp2pdf source code.
+
+    The on-disk caches include it in their keys, so upgrading mgp2pdf
+    doesn't reuse results computed by a different version.
+    """
+    with open(__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class LayoutCache(object):
+    """On-disk cache of word-wrapped slides.
+
+    Each slide is stored in a separate file, named after a hash of
+    everything that affects its layout: the slide contents and styles,
+    the page size, and the fonts (see ``key()``).
+    """
+
+    version = 3
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, slide, pageSize, fonts):
+        """Compute the cache key of a slide.
+
+        ``fonts`` is a dict mapping font names to TrueType font file names.
+        """
+        fonts = sorted((name, filename, fileStamp(filename))
+                       for name, filename in fonts.items())
+        data = (self.version, sourceHash(), reportlab.Version,
+                tuple(pageSize), fonts, slide.cacheKey())
+        return hashlib.sha256(repr(data).encode('UTF-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def restore(self, slides, keys):
+        """Replace the lines of slides with cached word-wrapped ones.
+
+        Returns the set of indices of slides that were found in the cache.
+        """
+        found = set()
+        for n, (slide, key) in enumerate(zip(slides, keys)):
+            try:
+                with open(self._filename(key), 'rb') as f:
+                    lines = pickle.load(f)
+            except Exception:
+                continue
+            slide.lines = lines
+            slide.wrapped = True
+            found.add(n)
+        return found
+
+    def store(self, slide, key):
+        """Store the (word-wrapped) lines of a slide in the cache."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        except OSError as e:
+            log.debug("Could not store slide layout in cache: %s", e)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(slide.lines, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._filename(key))
+        except Exception as e:
+            # Unpicklable slide contents must not abort the conversion
+            log.debug("Could not store slide layout in cache: %s", e)
+            with contextlib.suppress(OSError):
+                os.unlink(tmpname)
+
+
+class ParseCache(object):
+    """On-disk cache of parsed presentations.
+
+    Each presentation is stored in a separate file, named after a hash of
+    its filename and the options that affect parsing (see ``key()``).
+    The file also has the SHA-256 hashes of all the source files that
+    were read (the .mgp file and any %include'd files), and is ignored
+    if any of them have changed since.
+
+    Presentations that use %filter in unsafe mode are cached only with
+    --cache-filters, since the filter output could differ next time.
+    """
+
+    version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, filename, basedir, unsafe):
+        """Compute the cache key of a presentation."""
+        data = (self.version, sourceHash(), os.path.abspath(filename),
+                os.path.abspath(basedir) if basedir else '', bool(unsafe))
+        return hashlib.sha256(repr(data).encode('UTF-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    @staticmethod
+    def _digest(filename):
+        try:
+            with open(filename, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def load(self, key):
+        """Load a parsed presentation.
+
+        Returns the state stored by ``store()``, or None if it's not in
+        the cache or the source files have changed.
+        """
+        try:
+            with open(self._filename(key), 'rb') as f:
+                digests, state = pickle.load(f)
+        except Exception:
+            return None
+        for filename, digest in digests:
+            if self._digest(filename) != digest:
+                return None
+        return state
+
+    def store(self, key, state):
+        """Store a parsed presentation.
+
+        ``state`` is a dict with a ``sourceFiles`` item listing the files
+        that were parsed.
+        """
+        digests = [(fn, self._digest(fn)) for fn in state['sourceFiles']]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        except OSError as e:
+            log.debug("Could not store parsed presentation in cache: %s", e)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((digests, state), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._filename(key))
+        except Exception as e:
+            log.debug("Could not store parsed presentation in cache: %s", e)
+            with contextlib.suppress(OSError):
+                os.unlink(tmpname)
+
+
+class TTFontCache(object):
+    """On-disk cache of parsed TrueType fonts.
+
+    Parsing a large font (e.g. a CJK one) takes much longer than
+    unpickling the metrics and character maps extracted from it.  Each
+    font is stored in a separate file, named after a hash of the font
+    file's contents and the mgp2pdf and ReportLab versions.
+    """
+
+    version = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, name, filename):
+        """Load a TrueType font, using the cache if possible."""
+        with open(filename, 'rb') as f:
+            data = f.read()
+        key = hashlib.sha256(
+            repr((self.version, sourceHash(), reportlab.Version)
+                 ).encode('UTF-8') + data
+        ).hexdigest()
+        try:
+            with open(self._filename(key), 'rb') as f:
+                state = pickle.load(f)
+        except Exception:
+            font = TTFont(name, filename)
+            self.store(font.face, key)
+            return font
+        face = TTFontFace.__new__(TTFontFace)
+        face.__dict__.update(state)
+        face.filename = filename
+        face._ttf_data = data
+        face._pdfScale = _pdfScale(face.unitsPerEm)
+        font = TTFont.__new__(TTFont)
+        font.fontName = name
+        font.face = face
+        font.encoding = TTEncoding()
+        font.state = weakref.WeakKeyDictionary()
+        font._asciiReadable = rl_config.ttfAsciiReadable
+        font.shapable = _shapable(name)
+        log.debug("Loaded parsed font %s from cache", filename)
+        return font
+
+    def store(self, face, key):
+        """Store a parsed TrueType font face in the cache."""
+        # The font file itself is read again when loading, and the scaling
+        # function (a lambda) can't be pickled.
+        state = {k: v for k, v in face.__dict__.items()
+                 if k not in ('_ttf_data', '_pdfScale')}
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        except OSError as e:
+            log.debug("Could not store parsed font in cache: %s", e)
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpname, self._filename(key))
+        except Exception as e:
+            # Unpicklable font internals must not abort the conversion
+            log.debug("Could not store parsed font in cache: %s", e)
+            with contextlib.suppress(OSError):
+                os.unlink(tmpname)
+
+
+class FilterCache(object):
+    """On-disk cache of %filter output.
+
+    Each output is stored in a separate file, named after a hash of the
+    filter command, the input text and the working directory.  When the
+    total size of the cache exceeds ``maxSize`` bytes, the least recently
+    used entries are removed.
+    """
+
+    version = 1
+    maxSize = 64 * 1024 * 1024
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key(self, command, text, basedir):
+        """Compute the cache key of a filter invocation."""
+        data = (self.version, command, text, os.path.abspath(basedir))
+        return hashlib.sha256(repr(data).encode('UTF-8')).hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key + '.out')
+
+    def get(self, key):
+        """Return the cached output, or None."""
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                output = f.read().decode('UTF-8')
+            # remember when it was last used
+            os.utime(filename)
+        except (OSError, UnicodeDecodeError):
+            return None
+        return output
+
+    def store(self, key, output):
+        """Store the output of a filter in the cache."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(output.encode('UTF-8'))
+            os.replace(tmpname, self._filename(key))
+            self.evict()
+        except OSError as e:
+            log.debug("Could not store filter output in cache: %s", e)
+
+    def evict(self):
+        """Remove least recently used entries if the cache is too large."""
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.out'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.maxSize:
+                break
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+            total -= size
+
+
+def _pdfScale(unitsPerEm):
+    """Return a function that converts font units to PDF text space units.
+
+    This replicates what ReportLab's TTFontFile.extractInfo() does.
+    """
+    if unitsPerEm == 1000:
+        return lambda x: x
+    mult = 1000 / unitsPerEm
+    return lambda x: x * mult
+
+
+def _shapable(name):
+    """Return whether TTFont would enable text shaping for a font name.
+
+    This replicates what ReportLab's TTFont.__init__() does.
+    """
+    return not any(fnmatch.fnmatch(name, pattern)
+                   for pattern in getattr(rl_config, 'unShapedFontGlob', ()))
+
+
+def _initLayoutWorker(fonts):
+    """Register fonts in a layout worker process.
+
+    ``fonts`` is a dict mapping font names to TrueType font file names.
+
+    Worker processes forked from the main process will already have the
+    fonts, but spawned ones will not.
+    """
+    registered = set(pdfmetrics.getRegisteredFontNames())
+    for name, filename in fonts.items():
+        if name not in registered:
+            pdfmetrics.registerFont(Fonts.loadFont(name, filename))
+
+
+def _layOutSlides(slides, pageSize):
+    """Perform word-wrapping of a batch of slides in a worker process.
+
+    Returns the list of word-wrapped slides.
+    """
+    canvas = PresentationCanvas(io.BytesIO(), pageSize)
+    for slide in slides:
+        slide.layOut(canvas, pageSize)
+    return slides
+
+
+def _weightFromOpenType(weight):
+    """Convert an OpenType weight class (100..1000) to fontconfig's scale.
+
+        >>> _weightFromOpenType(400), _weightFromOpenType(700)
+        (80, 200)
+        >>> _weightFromOpenType(450)
+        90.0
+
+    """
+    # see FcWeightFromOpenTypeDouble() in fontconfig
+    mapping = [(100, 0), (200, 40), (300, 50), (350, 55), (380, 75),
+               (400, 80), (500, 100), (600, 180), (700, 200), (800, 205),
+               (900, 210), (1000, 215)]
+    if weight < 10:
+        # some old fonts use 1..9
+        weight *= 100
+    weight = min(max(weight, 100), 1000)
+    for (ot1, fc1), (ot2, fc2) in zip(mapping, mapping[1:]):
+        if weight == ot1:
+            return fc1
+        if weight < ot2:
+            return fc1 + (fc2 - fc1) * (weight - ot1) / (ot2 - ot1)
+    return fc2
+
+
+def _parseNameTable(data):
+    """Extract names from a TrueType 'name' table.
+
+    Returns a dict mapping name IDs to strings, preferring English
+    Windows names.
+    """
+    fmt, count, stringOffset = struct.unpack('>HHH', data[:6])
+    names = {}
+    for i in range(count):
+        platformID, encodingID, languageID, nameID, length, offset = \
+            struct.unpack('>HHHHHH', data[6 + 12 * i:18 + 12 * i])
+        raw = data[stringOffset + offset:stringOffset + offset + length]
+        if platformID == 3 and languageID == 0x409:
+            priority = 0
+        elif platformID in (0, 3):
+            priority = 1
+        elif platformID == 1 and languageID == 0:
+            priority = 2
+        else:
+            continue
+        if nameID not in names or priority < names[nameID][0]:
+            if platformID == 1:
+                text = raw.decode('mac_roman')
+            else:
+                text = raw.decode('UTF-16-BE', 'replace')
+            names[nameID] = (priority, text)
+    return {nameID: text for nameID, (priority, text) in names.items()}
+
+
+def readFontInfo(filename):
+    """Read the family name, weight and slant of a TrueType font file.
+
+    Weight and slant are returned in fontconfig units (see
+    ``Fonts.weights`` and ``Fonts.slants``).
+
+    Returns (family, weight, slant), or None if the file is not a
+    TrueType font.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            sfntVersion, numTables = struct.unpack('>4sH', f.read(6))
+            if sfntVersion not in (b'\0\1\0\0', b'true'):
+                return None
+            f.seek(12)
+            tables = {}
+            for i in range(numTables):
+                tag, checksum, offset, length = struct.unpack('>4sLLL', f.read(16))
+                tables[tag] = (offset, length)
+
+            def readTable(tag):
+                offset, length = tables[tag]
+                f.seek(offset)
+                return f.read(length)
+
+            names = _parseNameTable(readTable(b'name'))
+            family = names.get(16) or names[1]
+            weight = 80
+            slant = 0
+            if b'OS/2' in tables:
+                os2 = readTable(b'OS/2')
+                weight = _weightFromOpenType(struct.unpack('>H', os2[4:6])[0])
+                fsSelection = struct.unpack('>H', os2[62:64])[0]
+                if fsSelection & 0x200:
+                    slant = Fonts.slants['oblique']
+                elif fsSelection & 0x001:
+                    slant = Fonts.slants['italic']
+    except (OSError, KeyError, struct.error, UnicodeDecodeError):
+        return None
+    return family, weight, slant
+
+
+class FontIndex(object):
+    """An index of TrueType fonts found in a set of directories.
+
+    Resolves fontconfig-style patterns ("family:weight=200:slant=italic")
+    without running fc-match.
+    """
+
+    # Fallbacks for generic and common X11 family names
+    aliases = {
+        'sans': ['DejaVu Sans', 'Liberation Sans', 'Noto Sans', 'FreeSans',
+                 'Bitstream Vera Sans', 'Arial', 'Verdana'],
+        'serif': ['DejaVu Serif', 'Liberation Serif', 'Noto Serif',
+                  'FreeSerif', 'Bitstream Vera Serif', 'Times New Roman',
+                  'Georgia'],
+        'monospace': ['DejaVu Sans Mono', 'Liberation Mono', 'Noto Sans Mono',
+                      'FreeMono', 'Bitstream Vera Sans Mono', 'Courier New'],
+    }
+    aliases['sansserif'] = aliases['sans']
+    aliases['mono'] = aliases['monospace']
+    aliases['helvetica'] = ['Liberation Sans', 'Arial'] + aliases['sans']
+    aliases['arial'] = aliases['helvetica']
+    aliases['times'] = ['Liberation Serif', 'Times New Roman'] + aliases['serif']
+    aliases['courier'] = ['Liberation Mono', 'Courier New'] + aliases['monospace']
+
+    def __init__(self, directories=()):
+        # normalized family name -> [(weight, slant, filename)]
+        self.families = collections.defaultdict(list)
+        for directory in directories:
+            self.scan(directory)
+
+    @staticmethod
+    def _normalize(family):
+        return re.sub('[ _-]', '', family).lower()
+
+    def scan(self, directory):
+        """Add all TrueType fonts found in a directory tree."""
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.lower().endswith('.ttf'):
+                    self.add(os.path.join(dirpath, fn))
+
+    def add(self, filename):
+        """Add a font file to the index."""
+        info = readFontInfo(filename)
+        if info is None:
+            log.debug("Not a TrueType font: %s", filename)
+            return
+        family, weight, slant = info
+        self.families[self._normalize(family)].append((weight, slant, filename))
+
+    def match(self, pattern):
+        """Find the font file that best matches a fontconfig pattern.
+
+        Returns None if there are no fonts at all.
+        """
+        families, _, properties = pattern.partition(':')
+        weight = Fonts.weights['regular']
+        slant = Fonts.slants['roman']
+        for prop in properties.split(':'):
+            name, _, value = prop.partition('=')
+            name = name.strip().lower()
+            value = value.strip().lower()
+            if not value:
+                # constants like "bold" or "italic"
+                if name in Fonts.weights:
+                    weight = Fonts.weights[name]
+                elif name in Fonts.slants:
+                    slant = Fonts.slants[name]
+            elif name == 'weight':
+                weight = int(value) if value.isdigit() else Fonts.weights.get(value, weight)
+            elif name == 'slant':
+                slant = int(value) if value.isdigit() else Fonts.slants.get(value, slant)
+        candidates = [self._normalize(f) for f in families.split(',')]
+        for family in list(candidates):
+            candidates += map(self._normalize, self.aliases.get(family, []))
+        candidates += map(self._normalize, self.aliases['sans'])
+        candidates += sorted(self.families)
+        for family in candidates:
+            if family in self.families:
+                fonts = self.families[family]
+                return min(fonts, key=lambda font: (
+                    font[1] != slant, abs(font[0] - weight), font[2]))[2]
+        return None
 
 
 class Fonts(object):
@@ -1081,6 +2903,61 @@ class Fonts(object):
         'oblique': 110,
     }
 
+    # Directories scanned by FontIndex
+    fontDirectories = [
+        '/usr/share/fonts',
+        '/usr/local/share/fonts',
+        '~/.fonts',
+        '~/.local/share/fonts',
+        '/Library/Fonts',
+        '~/Library/Fonts',
+        os.path.join(os.environ.get('WINDIR', r'C:\Windows'), 'Fonts'),
+    ]
+
+    # Files and directories whose changes can affect font lookups
+    fontconfigPaths = [
+        '/etc/fonts/fonts.conf',
+        '/etc/fonts/conf.d',
+        '~/.config/fontconfig/fonts.conf',
+        '~/.config/fontconfig/conf.d',
+        '~/.fonts.conf',
+    ] + fontDirectories
+
+    # Lookup key -> (filename, fileStamp(filename)), shared by all
+    # presentations in this process
+    _resolved = {}
+
+    # The FontIndex, built on first use
+    _index = None
+
+    # (filename, fileStamp(filename)) -> (TTFont, seconds it took to parse),
+    # shared by all presentations in this process
+    _parsed = {}
+
+    def __init__(self, cache_dir=None, use_index=None):
+        self.files = {}
+        self.definitions = []
+        self.parsed = 0
+        self.reused = 0
+        self.parseTimeSaved = 0.0
+        self.cache_dir = cache_dir
+        self._disk_cache = None
+        self._fontconfig_stamp = None
+        if use_index is None:
+            use_index = shutil.which('fc-match') is None
+        self.use_index = use_index
+
+    @classmethod
+    def fontIndex(cls):
+        """Return the FontIndex of all installed fonts."""
+        if cls._index is None:
+            start = time.time()
+            cls._index = FontIndex(
+                os.path.expanduser(d) for d in cls.fontDirectories)
+            log.debug("Indexed %d font families in %.3fs",
+                      len(cls._index.families), time.time() - start)
+        return cls._index
+
     def define(self, name, engine, enginefontname):
         """Define a new font.
 
@@ -1094,6 +2971,7 @@ class Fonts(object):
         font engine.  For ``xfont`` it can be "family", "family-weight"
         or "family-weight-slant".  Or it can be a fontconfig pattern.
         """
+        definition = (name, engine, enginefontname)
         if engine != "xfont":
             raise NotImplementedError("unsupported font engine %s" % engine)
         if '-' in enginefontname and ':' not in enginefontname:
@@ -1108,14 +2986,152 @@ class Fonts(object):
                 weight = self.weights.get(weight, weight)
                 slant = {'i': 'italic', 'r': 'roman'}[slant]
                 enginefontname = '%s:weight=%s:slant=%s' % (family, weight, slant)
-        filename = subprocess.Popen(
-            ['fc-match', enginefontname, '-f', '%{file}'],
-            stdout=subprocess.PIPE).communicate()[0].strip()
+        filename = self.findFontFile(enginefontname)
         if not filename:
             sys.exit('Could not find the font file for %s' % enginefontname)
         log.debug("Font %s: %s -> %s" % (name, enginefontname, filename))
-        pdfmetrics.registerFont(TTFont(name, filename))
+        font = self.loadFont(name, filename, self.cache_dir)
+        if font.parseTime is None:
+            self.parsed += 1
+        else:
+            self.reused += 1
+            self.parseTimeSaved += font.parseTime
+        pdfmetrics.registerFont(font)
         pdfmetrics.getFont(name)  # just see if raises
+        self.files[name] = filename
+        self.definitions.append(definition)
+
+    @classmethod
+    def loadFont(cls, name, filename, cache_dir=None):
+        """Load a TrueType font.
+
+        Font files are parsed once per process (or until they change);
+        subsequent loads share the parsed glyph tables and metrics.
+
+        If ``cache_dir`` is specified, the parsed font is also kept there
+        (see ``TTFontCache``) for subsequent runs.
+
+        The returned TTFont has a ``parseTime`` attribute that is None if
+        the file had to be parsed, or the number of seconds that parsing
+        it took if the font was reused.
+        """
+        key = (filename, fileStamp(filename))
+        if key in cls._parsed:
+            parsed, parseTime = cls._parsed[key]
+            # The face is not modified after parsing, so it can be shared.
+            # Everything else TTFont.__init__() sets up is per font name, and
+            # the encoding and state are mutated while generating a PDF.
+            font = copy.copy(parsed)
+            font.fontName = name
+            font.encoding = TTEncoding()
+            font.state = weakref.WeakKeyDictionary()
+            font._asciiReadable = rl_config.ttfAsciiReadable
+            font.shapable = _shapable(name)
+            font.parseTime = parseTime
+            return font
+        start = time.time()
+        if cache_dir:
+            font = TTFontCache(os.path.join(cache_dir, 'ttf')).load(
+                name, filename)
+        else:
+            font = TTFont(name, filename)
+        for stale in [k for k in cls._parsed if k[0] == filename]:
+            del cls._parsed[stale]
+        cls._parsed[key] = (font, time.time() - start)
+        font.parseTime = None
+        return font
+
+    def findFontFile(self, pattern):
+        """Find the font file for a fontconfig pattern.
+
+        Uses fc-match, or the FontIndex if ``self.use_index`` is set.
+
+        Results are remembered for the lifetime of the process, and, if
+        ``self.cache_dir`` is set, on disk, until the fontconfig
+        configuration or the font file changes.
+
+        Returns None if no font matches.
+        """
+        key = ('index:' if self.use_index else 'fc-match:') + pattern
+        cached = self._resolved.get(key)
+        if cached is None and self.cache_dir:
+            cached = self._diskCache().get(key)
+        if cached is not None and fileStamp(cached[0]) == cached[1]:
+            filename = cached[0]
+        else:
+            if self.use_index:
+                filename = self.fontIndex().match(pattern)
+            else:
+                filename = self._fcMatch(pattern)
+            if not filename:
+                return None
+            cached = (filename, fileStamp(filename))
+            if self.cache_dir:
+                self._diskCache()[key] = cached
+                self._saveDiskCache()
+        self._resolved[key] = cached
+        return filename
+
+    @staticmethod
+    def _fcMatch(pattern):
+        filename = subprocess.Popen(
+            ['fc-match', pattern, '-f', '%{file}'],
+            stdout=subprocess.PIPE).communicate()[0].strip()
+        return os.fsdecode(filename)
+
+    def _fontconfigStamp(self):
+        if self._fontconfig_stamp is None:
+            paths = [os.path.expanduser(p) for p in self.fontconfigPaths]
+            if os.environ.get('FONTCONFIG_FILE'):
+                paths.append(os.environ['FONTCONFIG_FILE'])
+            stamps = []
+            for path in paths:
+                stamps.append((path, fileStamp(path)))
+                # Adding or removing a font only changes the mtime of the
+                # subdirectory it's in
+                for dirpath, dirnames, filenames in os.walk(path):
+                    dirnames.sort()
+                    stamps += [(os.path.join(dirpath, d),
+                                fileStamp(os.path.join(dirpath, d)))
+                               for d in dirnames]
+            self._fontconfig_stamp = hashlib.sha256(
+                repr(stamps).encode('UTF-8')).hexdigest()
+        return self._fontconfig_stamp
+
+    def _diskCacheFilename(self):
+        return os.path.join(self.cache_dir, 'fonts.json')
+
+    def _diskCache(self):
+        if self._disk_cache is None:
+            self._disk_cache = self._loadDiskCache()
+        return self._disk_cache
+
+    def _loadDiskCache(self):
+        try:
+            with open(self._diskCacheFilename()) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {}
+        if data.get('fontconfig') != self._fontconfigStamp():
+            return {}
+        return {pattern: (filename, tuple(stamp) if stamp else None)
+                for pattern, (filename, stamp) in data['fonts'].items()}
+
+    def _saveDiskCache(self):
+        # Other processes (e.g. mgp2pdf -j workers) may have stored their
+        # own lookups since we loaded the file; keep them
+        fonts = self._loadDiskCache()
+        fonts.update(self._disk_cache)
+        self._disk_cache = fonts
+        data = dict(fontconfig=self._fontconfigStamp(), fonts=fonts)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.cache_dir)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmpname, self._diskCacheFilename())
+        except OSError as e:
+            log.debug("Could not store font cache: %s", e)
 
 
 def setUpLogging(verbose=False):
@@ -1124,50 +3140,297 @@ def setUpLogging(verbose=False):
     root.setLevel(logging.DEBUG if verbose else logging.INFO)
 
 
+def outputFileName(fn, outfile=None):
+    """Determine the PDF file name for an input file.
+
+    ``outfile`` is the value of the -o option: a file name, a directory,
+    or None (meaning: put the PDF next to the input file).
+    """
+    pdf = os.path.splitext(fn)[0] + '.pdf'
+    if outfile:
+        if os.path.isdir(outfile):
+            pdf = os.path.join(outfile, os.path.basename(pdf))
+        else:
+            pdf = outfile
+    return pdf
+
+
+def _lineSuffix(lineno):
+    """Format a line number for an error message.
+
+        >>> _lineSuffix(42)
+        ' (line 42)'
+        >>> _lineSuffix(None)
+        ''
+
+    """
+    if lineno:
+        return " (line {0})".format(lineno)
+    return ""
+
+
+def convert(fn, outfile=None, unsafe=False, verbose=False, layout_jobs=1,
+            cache_dir=None, max_image_dpi=None, font_index=None,
+            cache_filters=False, filter_timeout=None, filter_max_output=None,
+            filter_workers=(), stream=False, dependencies=None):
+    """Convert a single .mgp file into a PDF.
+
+    Errors are logged.  Returns True on success, False on failure.
+
+    If ``stream`` is True, slides are rendered as soon as they're parsed
+    (see ``Presentation.streamPDF()``); ``verbose`` and ``layout_jobs``
+    are ignored then.
+
+    If ``dependencies`` is a set, the names of all the files that the
+    presentation depends on are added to it (even if loading fails
+    halfway).
+    """
+    log.debug("Loading %s", fn)
+    # Don't let styles accumulate when converting many files, or when
+    # reconverting the same one over and over with --watch
+    TextStyle.clearInterned()
+    title = os.path.splitext(os.path.basename(fn))[0]
+    p = Presentation(title=title, unsafe=unsafe, cache_dir=cache_dir,
+                     max_image_dpi=max_image_dpi, font_index=font_index,
+                     cache_filters=cache_filters,
+                     filter_timeout=filter_timeout,
+                     filter_max_output=filter_max_output,
+                     filter_workers=filter_workers)
+    if stream:
+        try:
+            outfile = outputFileName(fn, outfile)
+            p.streamPDF(fn, outfile)
+        except Exception as e:
+            log.debug("Exception while converting", exc_info=True)
+            log.error("Error converting %s: %s: %s%s",
+                      fn, e.__class__.__name__, e, _lineSuffix(p.lineno))
+            return False
+        finally:
+            if dependencies is not None:
+                dependencies.update(p.dependencies())
+        return True
+    try:
+        p.load(fn)
+    except Exception as e:
+        log.debug("Exception while parsing input file", exc_info=True)
+        log.error("Error loading %s: %s: %s%s",
+                  fn, e.__class__.__name__, e, _lineSuffix(p.lineno))
+        return False
+    finally:
+        if dependencies is not None:
+            dependencies.update(p.dependencies())
+    if verbose:
+        print(p)
+    try:
+        outfile = outputFileName(fn, outfile)
+        p.makePDF(outfile, jobs=layout_jobs)
+    except Exception as e:
+        log.debug("Exception while rendering PDF", exc_info=True)
+        log.error("Error generating %s: %s: %s",
+                  outfile, e.__class__.__name__, e)
+        return False
+    return True
+
+
+def waitForChanges(stamps, interval=1.0, debounce=0.3):
+    """Wait until some of the files change.
+
+    ``stamps`` is a dict mapping file names to their ``fileStamp()``.
+
+    Polls the files every ``interval`` seconds.  When a change is noticed,
+    keeps polling every ``debounce`` seconds until the files stop
+    changing, so that a burst of writes (e.g. an editor saving several
+    files) triggers just one reconversion.
+
+    Returns the set of files that changed.
+    """
+    while True:
+        time.sleep(interval)
+        current = {fn: fileStamp(fn) for fn in stamps}
+        if current != stamps:
+            break
+    while True:
+        time.sleep(debounce)
+        latest = {fn: fileStamp(fn) for fn in stamps}
+        if latest == current:
+            break
+        current = latest
+    return {fn for fn in stamps if current[fn] != stamps[fn]}
+
+
+def watch(filenames, **kw):
+    """Convert files, then keep reconverting them whenever they change.
+
+    Each presentation is reconverted only when the .mgp file or one of its
+    dependencies (see ``Presentation.dependencies()``) changes.
+
+    Runs until interrupted with Ctrl+C.
+    """
+    dependencies = {}
+    stamps = {}
+
+    def reconvert(fn):
+        # take the stamps before converting, so changes made while we're
+        # busy are not missed
+        before = {dep: fileStamp(dep) for dep in dependencies.get(fn, [fn])}
+        deps = {fn}
+        convert(fn, dependencies=deps, **kw)
+        dependencies[fn] = deps
+        for dep in deps:
+            stamps[dep] = before[dep] if dep in before else fileStamp(dep)
+
+    for fn in filenames:
+        reconvert(fn)
+    log.info("Watching for changes, press Ctrl+C to stop")
+    try:
+        while True:
+            changed = waitForChanges(stamps)
+            for fn in filenames:
+                if changed & dependencies[fn]:
+                    log.info("Reconverting %s", fn)
+                    reconvert(fn)
+            # forget files that are no longer used by any presentation
+            used = set().union(*dependencies.values())
+            for dep in set(stamps) - used:
+                del stamps[dep]
+    except KeyboardInterrupt:
+        pass
+
+
+def _convertInWorker(job):
+    """Call ``convert(fn, **kw)`` in a worker process.
+
+    ``job`` is a tuple (fn, kw).
+
+    All logging and printed output is captured so the parent process can
+    emit it in input file order.
+
+    Returns (success, output).
+    """
+    fn, kw = job
+    output = io.StringIO()
+    root = logging.getLogger()
+    saved_handlers, saved_level = root.handlers, root.level
+    root.handlers = [logging.StreamHandler(output)]
+    root.setLevel(logging.DEBUG if kw.get('verbose') else logging.INFO)
+    try:
+        with contextlib.redirect_stdout(output):
+            try:
+                success = convert(fn, **kw)
+            except SystemExit as e:
+                # Fatal errors like a missing font must not abort the other
+                # conversions and lose their output
+                log.error("Error converting %s: %s", fn, e)
+                success = False
+    finally:
+        root.handlers = saved_handlers
+        root.setLevel(saved_level)
+    return success, output.getvalue()
+
+
 def main(args=None):
     parser = optparse.OptionParser(usage='%prog [options] filename.mgp ...')
     parser.add_option('-v', action='store_true', dest='verbose', default=False,
                       help="print the presentation as text (debug)")
     parser.add_option('-o', action='store', dest='outfile',
                       help="output file name or directory (default: input file name with extension changed to .pdf)")
+    parser.add_option('-j', '--jobs', action='store', type='int', default=1,
+                      help="convert up to N files in parallel (default: 1)",
+                      metavar='N')
+    parser.add_option('--layout-jobs', action='store', type='int', default=1,
+                      help="lay out the slides of each file using N processes (default: 1)",
+                      metavar='N')
     parser.add_option('--unsafe', action='store_true', default=False,
                       help="enable %filter (security risk)")
+    parser.add_option('--filter-timeout', action='store', type='float',
+                      help="stop %filter commands that run longer than this",
+                      metavar='SECONDS')
+    parser.add_option('--filter-max-output', action='store', type='int',
+                      help="stop %filter commands that produce more output"
+                           " than this", metavar='BYTES')
+    parser.add_option('--filter-worker', action='append', default=[],
+                      dest='filter_workers', metavar='COMMAND',
+                      help="run this %filter command once, as a worker"
+                           " process that handles all the filter blocks"
+                           " (see FilterWorker in mgp2pdf.py for the"
+                           " protocol; can be repeated)")
+    parser.add_option('--max-image-dpi', action='store', type='int',
+                      help="downsample images that would be embedded at a"
+                           " higher resolution", metavar='DPI')
+    parser.add_option('--font-index', action='store_true', default=None,
+                      help="find fonts by scanning font directories instead of"
+                           " using fc-match (default if fc-match is not"
+                           " available)")
+    parser.add_option('--stream', action='store_true', default=False,
+                      help="render each slide as soon as it's parsed, to"
+                           " keep memory use low for very long presentations"
+                           " (can't be combined with -v or --layout-jobs)")
+    parser.add_option('--watch', action='store_true', default=False,
+                      help="keep running and reconvert files whenever they"
+                           " or any of the files they use change")
+    parser.add_option('--cache-dir', action='store',
+                      default=os.environ.get('MGP2PDF_CACHE_DIR'),
+                      help="cache intermediate results in this directory"
+                           " to speed up subsequent conversions"
+                           " (default: $MGP2PDF_CACHE_DIR, if set)")
+    parser.add_option('--no-cache', action='store_true', default=False,
+                      help="don't use the cache directory, even if"
+                           " --cache-dir or $MGP2PDF_CACHE_DIR is set"
+                           " (overrides --cache-filters)")
+    parser.add_option('--cache-filters', action='store_true', default=False,
+                      help="cache %filter output in the cache directory;"
+                           " use only with filters that always produce the"
+                           " same output for the same input")
     opts, args = parser.parse_args(args)
+    if opts.no_cache:
+        opts.cache_dir = None
+        opts.cache_filters = False
     if opts.outfile and len(args) > 1 and not os.path.isdir(opts.outfile):
         parser.error("%s must be a directory when you're converting multiple files" % opts.outfile)
     if not args:
         parser.error("nothing to do, try -h for help")
+    if opts.jobs < 1:
+        parser.error("-j expects a positive number")
+    if opts.layout_jobs < 1:
+        parser.error("--layout-jobs expects a positive number")
+    if opts.max_image_dpi is not None and opts.max_image_dpi < 1:
+        parser.error("--max-image-dpi expects a positive number")
+    if opts.filter_timeout is not None and opts.filter_timeout <= 0:
+        parser.error("--filter-timeout expects a positive number")
+    if opts.filter_max_output is not None and opts.filter_max_output < 1:
+        parser.error("--filter-max-output expects a positive number")
+    if opts.cache_filters and not opts.cache_dir:
+        parser.error("--cache-filters requires --cache-dir")
+    if opts.stream and (opts.verbose or opts.layout_jobs > 1):
+        parser.error("--stream can't be combined with -v or --layout-jobs")
     setUpLogging(opts.verbose)
-    for fn in args:
-        log.debug("Loading %s", fn)
-        title = os.path.splitext(os.path.basename(fn))[0]
-        p = Presentation(title=title, unsafe=opts.unsafe)
-        try:
-            p.load(fn)
-        except Exception as e:
-            log.debug("Exception while parsing input file", exc_info=True)
-            if p.lineno:
-                lineno = " (line {0})".format(p.lineno)
-            else:
-                lineno = ""
-            log.error("Error loading %s: %s: %s%s",
-                      fn, e.__class__.__name__, e, lineno)
-            continue
-        if opts.verbose:
-            print(p)
-        try:
-            outfile = os.path.splitext(fn)[0] + '.pdf'
-            if opts.outfile:
-                if os.path.isdir(opts.outfile):
-                    outfile = os.path.join(opts.outfile, os.path.basename(outfile))
-                else:
-                    outfile = opts.outfile
-            p.makePDF(outfile)
-        except Exception as e:
-            log.debug("Exception while rendering PDF", exc_info=True)
-            log.error("Error generating %s: %s: %s",
-                      outfile, e.__class__.__name__, e)
+    kw = dict(outfile=opts.outfile, unsafe=opts.unsafe, verbose=opts.verbose,
+              layout_jobs=opts.layout_jobs, cache_dir=opts.cache_dir,
+              max_image_dpi=opts.max_image_dpi, font_index=opts.font_index,
+              cache_filters=opts.cache_filters,
+              filter_timeout=opts.filter_timeout,
+              filter_max_output=opts.filter_max_output,
+              filter_workers=opts.filter_workers, stream=opts.stream)
+    if opts.watch:
+        watch(args, **kw)
+        return 0
+    jobs = [(fn, kw) for fn in args]
+    if opts.jobs > 1 and len(jobs) > 1:
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(opts.jobs) as pool:
+            for success, output in pool.map(_convertInWorker, jobs):
+                sys.stdout.write(output)
+                results.append(success)
+    else:
+        results = [convert(fn, **kw) for fn, kw in jobs]
+    failures = results.count(False)
+    if failures:
+        if len(results) > 1:
+            log.error("%d of %d files could not be converted",
+                      failures, len(results))
+        return 1
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -1,4 +1,6 @@
 #!/usr/bin/python
+import io
+import os
 import sys
 
 pagesize = 11
@@ -54,4 +56,28 @@ def format(lines):
         nlines += len(output)
 
 
-format(sys.stdin)
+def serve():
+    # mgp2pdf --filter-worker protocol: a byte count on a line by itself,
+    # followed by that many bytes of text, in both directions
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout
+    while True:
+        header = stdin.readline()
+        if not header:
+            break
+        text = stdin.read(int(header)).decode('UTF-8')
+        sys.stdout = io.StringIO()
+        try:
+            format(text.splitlines(True))
+            output = sys.stdout.getvalue().encode('UTF-8')
+        finally:
+            sys.stdout = stdout
+        stdout.buffer.write(b'%d\n' % len(output))
+        stdout.buffer.write(output)
+        stdout.buffer.flush()
+
+
+if os.environ.get('MGP2PDF_FILTER_WORKER'):
+    serve()
+else:
+    format(sys.stdin)
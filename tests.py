@@ -1,6 +1,13 @@
 import doctest
+import os
+import pickle
+import shutil
+import struct
 import sys
+import tempfile
+import threading
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 
 
@@ -11,6 +18,7 @@ except ImportError:
     from io import StringIO, BytesIO
 
 import mock
+import reportlab
 
 import mgp2pdf
 
@@ -18,6 +26,21 @@ import mgp2pdf
 PY2 = (bytes is str)
 
 
+class TempDirMixin(object):
+
+    def mkdtemp(self):
+        """Create a temporary directory that's removed after the test."""
+        tmpdir = tempfile.mkdtemp(prefix='mgp2pdf-test-')
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return tmpdir
+
+
+def register_vera():
+    from reportlab.pdfbase.ttfonts import TTFont
+    mgp2pdf.pdfmetrics.registerFont(TTFont('Vera', os.path.join(
+        os.path.dirname(reportlab.__file__), 'fonts', 'Vera.ttf')))
+
+
 sample_mgp = """\
 # This is an MGP file
 %%%%%%%%%%% This is also a comment
@@ -65,6 +88,131 @@ class TestColorParsing(unittest.TestCase):
                           'fuchsia')
 
 
+class TestPresentationCanvas(TempDirMixin, unittest.TestCase):
+
+    def test_stringWidth_is_cached(self):
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        w1 = canvas.stringWidth('Hello', 'Helvetica', 12)
+        w2 = canvas.stringWidth('Hello', 'Helvetica', 12)
+        w3 = canvas.stringWidth('Hello', 'Helvetica', 14)
+        self.assertEqual(w1, w2)
+        self.assertNotEqual(w1, w3)
+        stats = canvas.widthCacheInfo()
+        self.assertEqual((stats.hits, stats.misses), (1, 2))
+
+    def test_stringWidth_defaults_to_current_font(self):
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        canvas.setFont('Courier', 10)
+        self.assertEqual(canvas.stringWidth('Hi'),
+                         canvas.stringWidth('Hi', 'Courier', 10))
+
+    def test_prefixWidths(self):
+        register_vera()
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        for text in [u'Hello, world!', u'\u0105\u010d\u0119 \U0001F600 x', u'']:
+            widths = canvas.prefixWidths(text, 'Vera', 12)
+            self.assertEqual(len(widths), len(text) + 1)
+            for n, width in enumerate(widths):
+                self.assertEqual(width, canvas.stringWidth(text[:n], 'Vera', 12))
+
+    def test_prefixWidths_limit(self):
+        register_vera()
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        text = u'word ' * 1000
+        widths = canvas.prefixWidths(text, 'Vera', 10, 100)
+        self.assertGreater(widths[-1], 100)
+        self.assertLessEqual(widths[-2], 100)
+        self.assertEqual(widths[-1], canvas.stringWidth(
+            text[:len(widths) - 1], 'Vera', 10))
+        self.assertEqual(len(canvas.prefixWidths(u'word', 'Vera', 10, 100)), 5)
+
+    def test_prefixWidths_not_truetype(self):
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        self.assertIsNone(canvas.prefixWidths('Hello', 'Helvetica', 12))
+        self.assertIsNone(canvas.prefixWidths('Hello', 'Helvetica', 12))
+
+    def test_drawImage_embeds_once(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        filename = os.path.join(tmpdir, 'logo.png')
+        PILImage.new('RGB', (40, 30)).save(filename)
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        self.assertEqual(canvas.drawImage(filename, 0, 0, 40, 30), (40, 30))
+        canvas.showPage()
+        self.assertEqual(canvas.drawImage(filename, 10, 10, 20, 15), (40, 30))
+        self.assertEqual(canvas.drawImage(filename, 10, 10, 20, 15), (40, 30))
+        # different mask, different XObject
+        canvas.drawImage(filename, 10, 10, 20, 15, mask='auto')
+        # ImageReaders are passed through to ReportLab
+        canvas.drawImage(mgp2pdf.ImageReader(filename), 0, 0, 40, 30)
+        canvas.showPage()
+        canvas.save()
+        self.assertEqual((canvas.imagesEmbedded, canvas.imagesReferenced),
+                         (3, 2))
+
+    def test_downsampleImage(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        cachedir = os.path.join(tmpdir, 'cache')
+        filename = os.path.join(tmpdir, 'screenshot.gif')
+        PILImage.new('P', (400, 300)).save(filename)
+        canvas = mgp2pdf.PresentationCanvas(BytesIO(), maxImageDPI=144,
+                                            imageCacheDir=cachedir)
+        # small enough
+        self.assertEqual(canvas.downsampleImage(filename, 200, 150), filename)
+        # too big
+        small = canvas.downsampleImage(filename, 100, 75)
+        self.assertEqual(os.path.dirname(small), cachedir)
+        self.assertEqual(PILImage.open(small).size, (200, 150))
+        self.assertEqual(canvas.drawImage(filename, 0, 0, 100, 75), (200, 150))
+        canvas.save()
+        # the downsampled image is reused by the next run
+        os.utime(small, (0, 0))
+        canvas = mgp2pdf.PresentationCanvas(BytesIO(), maxImageDPI=144,
+                                            imageCacheDir=cachedir)
+        self.assertEqual(canvas.downsampleImage(filename, 100, 75), small)
+        self.assertEqual(os.stat(small).st_mtime, 0)
+
+    def test_downsampleImage_without_cache(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        filename = os.path.join(tmpdir, 'photo.jpg')
+        PILImage.new('RGB', (400, 300)).save(filename)
+        canvas = mgp2pdf.PresentationCanvas(BytesIO(), maxImageDPI=72)
+        small = canvas.downsampleImage(filename, 100, 75)
+        self.assertTrue(small.endswith('-100x75.jpg'))
+        self.assertEqual(canvas.drawImage(filename, 0, 0, 100, 75), (100, 75))
+        canvas.save()
+        # temporary files are cleaned up
+        self.assertFalse(os.path.exists(small))
+
+    def test_downsampleImage_cmyk_jpeg(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        cachedir = os.path.join(tmpdir, 'cache')
+        filename = os.path.join(tmpdir, 'print.jpg')
+        PILImage.new('CMYK', (400, 300)).save(filename)
+        canvas = mgp2pdf.PresentationCanvas(BytesIO(), maxImageDPI=72,
+                                            imageCacheDir=cachedir)
+        small = canvas.downsampleImage(filename, 100, 75)
+        self.assertTrue(small.endswith('-100x75.jpg'))
+        self.assertEqual(PILImage.open(small).mode, 'RGB')
+
+    def test_downsampleImage_error_cleans_up(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        cachedir = os.path.join(tmpdir, 'cache')
+        filename = os.path.join(tmpdir, 'photo.jpg')
+        PILImage.new('RGB', (400, 300)).save(filename)
+        canvas = mgp2pdf.PresentationCanvas(BytesIO(), maxImageDPI=72,
+                                            imageCacheDir=cachedir)
+        with mock.patch.object(PILImage.Image, 'save',
+                               side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                canvas.downsampleImage(filename, 100, 75)
+        self.assertEqual(os.listdir(cachedir), [])
+
+
 class TestTextWrapping(unittest.TestCase):
 
     def test_textWrapPositions_unicode(self):
@@ -95,6 +243,32 @@ class TestLine(unittest.TestCase):
         # samples/ triggered this special case.
         self.assertEqual((w, h), (100, 51))
 
+    def test_split_many_chunks(self):
+        calls = []
+
+        class Box(mgp2pdf.SimpleChunk):
+            def size(self, canvas, w, h):
+                calls.append(self)
+                return 10, 10
+
+        n = 20000
+        line = mgp2pdf.Line()
+        for i in range(n):
+            line.add(Box())
+        # 2000 output lines would exceed the recursion limit if split()
+        # recursed once per line
+        lines = line.split(mock.Mock(), 100, 100)
+        self.assertEqual(len(lines), n // 10)
+        self.assertTrue(all(len(ln.chunks) == 10 for ln in lines))
+        # linear: every chunk gets measured at most twice (once when it
+        # doesn't fit at the end of a line, and again on the next line)
+        self.assertLessEqual(len(calls), 2 * n)
+
+    def test_split_keeps_line_if_it_fits(self):
+        line = mgp2pdf.Line()
+        line.add(mgp2pdf.SimpleChunk())
+        self.assertEqual(line.split(mock.Mock(), 100, 100), [line])
+
 
 class TestSimpleChunk(unittest.TestCase):
 
@@ -115,7 +289,7 @@ class TestSimpleChunk(unittest.TestCase):
         self.assertEqual(str(chunk), '<SimpleChunk>')
 
 
-class TestImage(unittest.TestCase):
+class TestImage(TempDirMixin, unittest.TestCase):
 
     @mock.patch('mgp2pdf.ImageReader')
     @mock.patch('mgp2pdf.log')
@@ -127,8 +301,36 @@ class TestImage(unittest.TestCase):
         x, y = img.drawOn(canvas, 10, 20, 100, 200)
         self.assertEqual((x, y), (60, 20))
 
-
-class TestTextChunk(unittest.TestCase):
+    @mock.patch('mgp2pdf.ImageReader')
+    def test_image_is_loaded_lazily(self, mock_ImageReader):
+        img = mgp2pdf.Image('image.png')
+        self.assertFalse(mock_ImageReader.called)
+        img.image
+        img.image
+        mock_ImageReader.assert_called_once_with('image.png')
+
+    def test_images_are_shared(self):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        self.addCleanup(mgp2pdf.image_cache.clear)
+        filename = os.path.join(tmpdir, 'logo.png')
+        PILImage.new('RGB', (40, 30)).save(filename)
+        img1 = mgp2pdf.Image(filename)
+        img2 = mgp2pdf.Image(filename, zoom=50)
+        self.assertIs(img1.image, img2.image)
+        self.assertEqual(img2.size(None, 100, 100), (20, 15))
+        # the image is not pickled
+        img3 = pickle.loads(pickle.dumps(img1))
+        self.assertIsNone(img3._image)
+        self.assertIs(img3.image, img1.image)
+        # a changed file is loaded again
+        PILImage.new('RGB', (80, 60)).save(filename)
+        os.utime(filename, (0, 0))
+        self.assertEqual(mgp2pdf.Image(filename).size(None, 100, 100),
+                         (80, 60))
+
+
+class TestTextChunk(TempDirMixin, unittest.TestCase):
 
     def test_split_when_it_cant(self):
         canvas = mock.Mock()
@@ -140,8 +342,629 @@ class TestTextChunk(unittest.TestCase):
         self.assertEqual(bits[0].text, "this-is-a-very-long,")
         self.assertEqual(bits[1].text, "unsplittable, word")
 
+    def test_split_picks_longest_prefix_that_fits(self):
+        measured = []
+        canvas = mock.Mock()
+        canvas.stringWidth = lambda s, font, size: measured.append(s) or len(s) * 7
+        chunk = mgp2pdf.TextChunk(" ".join(["word"] * 1000),
+                                  "Arial", 6, 0, mgp2pdf.parse_color("black"))
+        bits = chunk.split(canvas, 1024, 768, 7 * 42)
+        self.assertEqual(bits[0].text, " ".join(["word"] * 8))
+        self.assertEqual(len(bits[1].text), 4 * 992 + 991)
+        # only the words up to the break point are measured
+        self.assertLess(len(measured), 15)
+
+    def test_styles_are_shared(self):
+        chunk = mgp2pdf.TextChunk("Hello world", "Arial", 6, 0,
+                                  mgp2pdf.parse_color("#fff"))
+        other = mgp2pdf.TextChunk("Bye", "Arial", 6, 0,
+                                  mgp2pdf.parse_color("white"))
+        self.assertIs(chunk.style, other.style)
+        self.assertEqual((chunk.font, chunk.fontSize, chunk.vgap),
+                         ("Arial", 6, 0))
+        self.assertIs(chunk.color, mgp2pdf.parse_color("#fff"))
+        clone = chunk.cloneStyle("world")
+        self.assertIs(clone.style, chunk.style)
+        self.assertEqual(clone.text, "world")
+        # unpickled chunks share the style too
+        copy = pickle.loads(pickle.dumps(chunk))
+        self.assertIs(copy.style, chunk.style)
+        self.assertEqual(copy.text, "Hello world")
+
+    def test_convert_forgets_styles(self):
+        tmpdir = self.mkdtemp()
+        fn = os.path.join(tmpdir, 'talk.mgp')
+        with open(fn, 'w') as f:
+            f.write('%page\nHello\n')
+        style = mgp2pdf.TextStyle.get("Arial", 99, 0, mgp2pdf.black)
+        self.assertTrue(mgp2pdf.convert(fn))
+        self.assertNotIn(style, mgp2pdf.TextStyle._interned)
+        self.assertIsNot(
+            mgp2pdf.TextStyle.get("Arial", 99, 0, mgp2pdf.black), style)
+
+    def test_slots(self):
+        chunk = mgp2pdf.TextChunk("Hello", "Arial", 6, 0, mgp2pdf.black)
+        for obj in [chunk, mgp2pdf.Line(), mgp2pdf.Slide(), mgp2pdf.Mark(),
+                    mgp2pdf.Again(None), mgp2pdf.Image('cat.png')]:
+            self.assertFalse(hasattr(obj, '__dict__'), obj)
+
+
+class TestTextChunkBulkMeasurement(unittest.TestCase):
+
+    def setUp(self):
+        register_vera()
+        self.canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        self.text = ' '.join('word%d' % (n * 7 % 13) * (n % 3 + 1)
+                             for n in range(200))
+
+    def makeChunk(self, text=None, font='Vera'):
+        return mgp2pdf.TextChunk(self.text if text is None else text,
+                                 font, 3, 0, mgp2pdf.parse_color('black'))
+
+    def slowSplit(self, chunk, canvas, maxw):
+        with mock.patch.object(mgp2pdf.TextChunk, 'bulkMeasureThreshold',
+                               sys.maxsize):
+            return [bit.text for bit in chunk.split(canvas, 1024, 768, maxw)]
+
+    def fastSplit(self, chunk, canvas, maxw):
+        return [bit.text for bit in chunk.split(canvas, 1024, 768, maxw)]
+
+    def test_prefixWidths(self):
+        chunk = self.makeChunk('ab\tcd\t\tefg')
+        widths = chunk.prefixWidths(self.canvas, 1024, 768, 1000)
+        self.assertEqual(widths, [
+            chunk.size(self.canvas, 1024, 768, chunk.text[:n])[0]
+            for n in range(len(chunk.text) + 1)])
+        widths = chunk.prefixWidths(self.canvas, 1024, 768, 1)
+        self.assertEqual(len(widths), 2)
+
+    def test_prefixWidths_unsupported(self):
+        chunk = self.makeChunk()
+        self.assertIsNone(chunk.prefixWidths(mock.Mock(), 1024, 768, 100))
+        chunk = self.makeChunk(font='Helvetica')
+        self.assertIsNone(chunk.prefixWidths(self.canvas, 1024, 768, 100))
+        self.assertEqual(self.fastSplit(chunk, self.canvas, 100),
+                         self.slowSplit(chunk, self.canvas, 100))
+
+    def test_tooWide(self):
+        chunk = self.makeChunk()
+        self.assertTrue(chunk.tooWide(self.canvas, 1024, 768, 100))
+        self.assertFalse(chunk.tooWide(self.canvas, 1024, 768, 1e6))
+        chunk = self.makeChunk('short')
+        self.assertFalse(chunk.tooWide(self.canvas, 1024, 768, 0))
+        self.assertFalse(mgp2pdf.SimpleChunk().tooWide(self.canvas, 1, 1, 0))
+
+    def test_split_matches_bisection(self):
+        chunks = [self.makeChunk(),
+                  self.makeChunk('x' * 500 + ' ' + self.text),
+                  self.makeChunk('x' * 1000)]
+        for chunk in chunks:
+            for maxw in [0, 5, 50, 100, 250, 1e7]:
+                self.assertEqual(self.fastSplit(chunk, self.canvas, maxw),
+                                 self.slowSplit(chunk, self.canvas, maxw))
+
+    def test_split_double_checks(self):
+        chunk = self.makeChunk()
+        first, second = self.text.split()[:2]
+
+        def width(text):
+            return chunk.size(self.canvas, 1024, 768, text)[0]
+
+        # Pretend that ReportLab rounds widths differently from us
+        for error, maxw in [(0.01, width(first)),
+                            (-0.01, width(first) - 0.005),
+                            (-0.01, width(first + ' ' + second) - 0.005)]:
+            canvas = mgp2pdf.PresentationCanvas(BytesIO())
+            canvas._stringWidth = (
+                lambda text, font, size, error=error:
+                mgp2pdf.pdfmetrics.stringWidth(text, font, size) + error)
+            self.assertEqual(self.fastSplit(chunk, canvas, maxw),
+                             self.slowSplit(chunk, canvas, maxw))
+
+    def referenceSplit(self, chunk, canvas, maxw):
+        # The longest prefix that fits, measured from scratch
+        fitting = [pos for pos in mgp2pdf.textWrapPositions(chunk.text)
+                   if chunk.size(canvas, 1024, 768, chunk.text[:pos])[0]
+                   <= maxw]
+        if fitting:
+            pos = fitting[0]
+        else:
+            pos = mgp2pdf.textWrapPositions(chunk.text)[-1]
+        if not fitting and pos == len(chunk.text):
+            return [chunk.text]
+        return [chunk.text[:pos], chunk.text[pos:].lstrip()]
+
+    def test_split_by_words(self):
+        chunks = [self.makeChunk(font='Helvetica'),
+                  self.makeChunk('ab\tcd ef\t\tgh ' * 50, font='Helvetica'),
+                  self.makeChunk('x' * 1000, font='Helvetica')]
+        for chunk in chunks:
+            for maxw in [0, 5, 50, 100, 250, 1e7]:
+                self.assertEqual(self.fastSplit(chunk, self.canvas, maxw),
+                                 self.referenceSplit(chunk, self.canvas, maxw))
+
+    def test_split_by_words_double_checks(self):
+        chunk = self.makeChunk(font='Helvetica')
+        first, second = self.text.split()[:2]
+        width = mgp2pdf.pdfmetrics.stringWidth(first + ' ' + second,
+                                               'Helvetica', 3 * 768 / 100)
+        # Pretend that ReportLab rounds widths differently from us, so the
+        # sum of the word widths is off by twice as much as the width of
+        # the two words
+        for error, maxw in [(0.5, width + 0.5), (-0.5, width - 0.75)]:
+            canvas = mgp2pdf.PresentationCanvas(BytesIO())
+            canvas._stringWidth = (
+                lambda text, font, size, error=error:
+                mgp2pdf.pdfmetrics.stringWidth(text, font, size) + error)
+            self.assertEqual(self.fastSplit(chunk, canvas, maxw),
+                             self.referenceSplit(chunk, canvas, maxw))
+
+    def test_tooWide_without_advance_table(self):
+        chunk = self.makeChunk(font='Helvetica')
+        self.assertTrue(chunk.tooWide(self.canvas, 1024, 768, 100))
+        self.assertFalse(chunk.tooWide(self.canvas, 1024, 768, 1e6))
+
+    def test_Line_split_scales_linearly(self):
+        measured = []
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        canvas._stringWidth = (
+            lambda text, font, size:
+            measured.append(len(text)) or
+            mgp2pdf.pdfmetrics.stringWidth(text, font, size))
+
+        def work(words):
+            del measured[:]
+            line = mgp2pdf.Line()
+            line.add(self.makeChunk(' '.join(['word'] * words),
+                                    font='Helvetica'))
+            self.assertGreater(len(line.split(canvas, 400, 768)), words // 10)
+            return sum(measured)
+
+        # Twice the text, twice the work (not four times, as before)
+        self.assertLess(work(4000), 2.2 * work(2000))
+
+    def test_Line_split(self):
+        line = mgp2pdf.Line()
+        line.add(self.makeChunk())
+        self.assertEqual(
+            ' '.join(str(ln) for ln in line.split(self.canvas, 400, 768)),
+            self.text)
+
+
+class TestLayoutCache(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+
+    @mock.patch('mgp2pdf.log')
+    def test_makePDF_reuses_layout(self, mock_log):
+        p = mgp2pdf.Presentation(StringIO(sample_mgp), cache_dir=self.tmpdir)
+        p.makePDF(BytesIO())
+        mock_log.debug.assert_any_call(
+            "Layout cache: %d slides reused, %d laid out", 0, 6)
+        expected = str(p)
+        mock_log.reset_mock()
+        p = mgp2pdf.Presentation(StringIO(sample_mgp), cache_dir=self.tmpdir)
+        p.makePDF(BytesIO())
+        mock_log.debug.assert_any_call(
+            "Layout cache: %d slides reused, %d laid out", 6, 0)
+        self.assertEqual(str(p), expected)
+        mock_log.reset_mock()
+        source = sample_mgp.replace('Hello', 'Howdy', 1)
+        p = mgp2pdf.Presentation(StringIO(source), cache_dir=self.tmpdir)
+        p.makePDF(BytesIO())
+        mock_log.debug.assert_any_call(
+            "Layout cache: %d slides reused, %d laid out", 5, 1)
+
+    @mock.patch('mgp2pdf.log')
+    def test_streamPDF_reuses_layout(self, mock_log):
+        p = mgp2pdf.Presentation(cache_dir=self.tmpdir)
+        p.streamPDF(StringIO(sample_mgp), BytesIO())
+        mock_log.debug.assert_any_call(
+            "Layout cache: %d slides reused, %d laid out", 0, 6)
+        source = sample_mgp.replace('Hello', 'Howdy', 1)
+        p = mgp2pdf.Presentation(cache_dir=self.tmpdir)
+        p.streamPDF(StringIO(source), BytesIO())
+        mock_log.debug.assert_any_call(
+            "Layout cache: %d slides reused, %d laid out", 5, 1)
+
+    @mock.patch('mgp2pdf.ImageReader')
+    def test_key_depends_on_page_size_and_fonts(self, mock_ImageReader):
+        cache = mgp2pdf.LayoutCache(self.tmpdir)
+        slide = mgp2pdf.Slide()
+        slide.addText('Hello')
+        slide.addImage('cat.png')
+        slide.addMark()
+        key = cache.key(slide, (100, 100), {})
+        self.assertEqual(key, cache.key(slide, (100, 100), {}))
+        self.assertNotEqual(key, cache.key(slide, (200, 100), {}))
+        self.assertNotEqual(key, cache.key(slide, (100, 100),
+                                           {'mono': '/mono.ttf'}))
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_error_handling(self, mock_log):
+        filename = os.path.join(self.tmpdir, 'file')
+        open(filename, 'w').close()
+        cache = mgp2pdf.LayoutCache(filename)
+        cache.store(mgp2pdf.Slide(), 'key')
+        self.assertEqual(cache.restore([mgp2pdf.Slide()], ['key']), set())
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_pickling_error(self, mock_log):
+        cache = mgp2pdf.LayoutCache(self.tmpdir)
+        slide = mgp2pdf.Slide()
+        slide.lines = [lambda: None]
+        cache.store(slide, 'key')
+        mock_log.debug.assert_called_once_with(
+            "Could not store slide layout in cache: %s", mock.ANY)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_key_depends_on_source_code(self):
+        cache = mgp2pdf.LayoutCache(self.tmpdir)
+        key = cache.key(mgp2pdf.Slide(), (100, 100), {})
+        with mock.patch('mgp2pdf.sourceHash', return_value='0' * 64):
+            self.assertNotEqual(key, cache.key(mgp2pdf.Slide(), (100, 100),
+                                               {}))
+
+    def test_fileStamp(self):
+        self.assertIsNone(mgp2pdf.fileStamp('/nonexistent/file'))
+        self.assertIsNotNone(mgp2pdf.fileStamp(self.tmpdir))
+
+
+class TestParseCache(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+        self.cache_dir = os.path.join(self.tmpdir, 'cache')
+        self.filename = self.write('talk.mgp', '%include "preamble.mgp"\n'
+                                   '%page\nHello\n%newimage "logo.png"\n')
+        self.preamble = self.write('preamble.mgp', '%default 1 size 5\n')
+
+    def write(self, name, text):
+        filename = os.path.join(self.tmpdir, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def load(self, **kw):
+        p = mgp2pdf.Presentation(cache_dir=self.cache_dir, **kw)
+        p.load(self.filename)
+        return p
+
+    def test_reuse(self):
+        expected = self.load()
+        with mock.patch.object(mgp2pdf.Presentation, 'iterSlides',
+                               side_effect=AssertionError('parsed again')):
+            p = self.load()
+        self.assertEqual(str(p), str(expected))
+        self.assertEqual(p.basedir, self.tmpdir)
+        self.assertEqual(p.dependencies(), expected.dependencies())
+        self.assertEqual(p.defaultDirectives, {1: ['size 5']})
+        p._handleDirectives('%page')
+        p._handleText('World')
+        self.assertEqual(p.slides[-1].lines[0].chunks[0].fontSize, 5)
+
+    def test_changed_sources(self):
+        self.load()
+        self.write('preamble.mgp', '%default 1 size 6\n')
+        p = self.load()
+        self.assertEqual(p.slides[0].lines[0].chunks[0].fontSize, 6)
+        os.unlink(self.preamble)
+        self.assertRaises(IOError, self.load)
+
+    def test_fonts_are_defined_again(self):
+        with mock.patch.object(mgp2pdf.Fonts, 'define') as mock_define:
+            p = mgp2pdf.Presentation(cache_dir=self.cache_dir)
+            p.fonts.definitions.append(('mono', 'xfont', 'Monospace'))
+            p.load(self.filename)
+            mock_define.reset_mock()
+            self.load()
+        mock_define.assert_called_once_with('mono', 'xfont', 'Monospace')
+
+    def runFilter(self, command, lines, emit):
+        emit('Hi\n')
+        emit(None)
+        return 0
+
+    def test_filters(self):
+        self.write('talk.mgp', '%page\n%filter "cat"\n%endfilter\n')
+        with mock.patch.object(mgp2pdf.Presentation, '_runFilter',
+                               self.runFilter):
+            self.load(unsafe=True)
+            self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'parsed')))
+            self.load(unsafe=True, cache_filters=True)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'parsed'))), 1)
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_failed_filters(self):
+        self.write('talk.mgp', '%page\n%filter "echo Hi; exit 1"\n%endfilter\n')
+        p = self.load(unsafe=True, cache_filters=True)
+        self.assertEqual(str(p.slides[-1]), 'Hi')
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, 'parsed')))
+
+    def test_key_depends_on_source_code(self):
+        cache = mgp2pdf.ParseCache(self.cache_dir)
+        key = cache.key(self.filename, '', False)
+        with mock.patch('mgp2pdf.sourceHash', return_value='0' * 64):
+            self.assertNotEqual(key, cache.key(self.filename, '', False))
+
+    def test_file_objects_are_not_cached(self):
+        p = mgp2pdf.Presentation(cache_dir=self.cache_dir)
+        p.load(StringIO('%page\nHello\n'))
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_corrupted_cache(self):
+        expected = str(self.load())
+        directory = os.path.join(self.cache_dir, 'parsed')
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name), 'wb') as f:
+                f.write(b'garbage')
+        self.assertEqual(str(self.load()), expected)
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_error_handling(self, mock_log):
+        open(self.cache_dir, 'w').close()
+        self.load()
+        mock_log.debug.assert_called_with(
+            "Could not store parsed presentation in cache: %s", mock.ANY)
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_pickling_error(self, mock_log):
+        cache = mgp2pdf.ParseCache(self.cache_dir)
+        cache.store('key', dict(sourceFiles=[], slides=[lambda: None]))
+        mock_log.debug.assert_called_once_with(
+            "Could not store parsed presentation in cache: %s", mock.ANY)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+
+class TestTTFontCache(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+        self.fontfile = os.path.join(os.path.dirname(reportlab.__file__),
+                                     'fonts', 'Vera.ttf')
+
+    def getSubset(self, font):
+        doc = mock.Mock()
+        font.splitString(u'Hello, world!', doc)
+        return font.face.makeSubset(font.state[doc].subsets[0])
+
+    @mock.patch('mgp2pdf.log')
+    def test_load(self, mock_log):
+        cache = mgp2pdf.TTFontCache(self.tmpdir)
+        font1 = cache.load('one', self.fontfile)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 1)
+        self.assertFalse(mock_log.debug.called)
+        font2 = cache.load('two', self.fontfile)
+        self.assertTrue(mock_log.debug.called)
+        self.assertEqual(font2.fontName, 'two')
+        self.assertIsNot(font1.face, font2.face)
+        self.assertEqual(font1.face.charWidths, font2.face.charWidths)
+        self.assertEqual(font1.stringWidth(u'Hello', 10),
+                         font2.stringWidth(u'Hello', 10))
+        self.assertEqual(self.getSubset(font1), self.getSubset(font2))
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_error_handling(self, mock_log):
+        filename = os.path.join(self.tmpdir, 'file')
+        open(filename, 'w').close()
+        cache = mgp2pdf.TTFontCache(filename)
+        cache.load('one', self.fontfile)
+        self.assertEqual(cache.load('two', self.fontfile).fontName, 'two')
+        mock_log.debug.assert_called_with(
+            "Could not store parsed font in cache: %s", mock.ANY)
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_pickling_error(self, mock_log):
+        cache = mgp2pdf.TTFontCache(self.tmpdir)
+        face = mgp2pdf.TTFontFace.__new__(mgp2pdf.TTFontFace)
+        face.charWidths = lambda: None
+        cache.store(face, 'key')
+        mock_log.debug.assert_called_once_with(
+            "Could not store parsed font in cache: %s", mock.ANY)
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_key_depends_on_source_code(self):
+        cache = mgp2pdf.TTFontCache(self.tmpdir)
+        cache.load('one', self.fontfile)
+        with mock.patch('mgp2pdf.sourceHash', return_value='0' * 64):
+            cache.load('two', self.fontfile)
+        self.assertEqual(len(os.listdir(self.tmpdir)), 2)
+
+    @mock.patch.dict(mgp2pdf.Fonts._parsed, clear=True)
+    def test_loadFont(self):
+        mgp2pdf.Fonts.loadFont('one', self.fontfile, self.tmpdir)
+        self.assertEqual(os.listdir(self.tmpdir), ['ttf'])
+
+    def test_pdfScale(self):
+        self.assertEqual(mgp2pdf._pdfScale(1000)(42), 42)
+        self.assertEqual(mgp2pdf._pdfScale(2048)(1024), 500.0)
+
+
+class TestFilterCache(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+
+    def test_key(self):
+        cache = mgp2pdf.FilterCache(self.tmpdir)
+        key = cache.key('cat', 'Hello\n', 'samples')
+        self.assertEqual(key, cache.key('cat', 'Hello\n', 'samples'))
+        self.assertNotEqual(key, cache.key('tac', 'Hello\n', 'samples'))
+        self.assertNotEqual(key, cache.key('cat', 'Hello!\n', 'samples'))
+        self.assertNotEqual(key, cache.key('cat', 'Hello\n', ''))
+
+    def test_get_and_store(self):
+        cache = mgp2pdf.FilterCache(os.path.join(self.tmpdir, 'filters'))
+        self.assertIsNone(cache.get('key'))
+        cache.store('key', u'Moo! \u2603\n')
+        self.assertEqual(cache.get('key'), u'Moo! \u2603\n')
+
+    def test_eviction(self):
+        cache = mgp2pdf.FilterCache(self.tmpdir)
+        cache.maxSize = 35
+        open(os.path.join(self.tmpdir, 'unrelated'), 'w').close()
+        for n, key in enumerate(['a', 'b', 'c']):
+            cache.store(key, '0123456789')
+            os.utime(cache._filename(key), (n, n))
+        cache.get('a')
+        cache.store('d', '0123456789')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['a.out', 'c.out', 'd.out', 'unrelated'])
+
+    @mock.patch('mgp2pdf.log')
+    def test_store_error_handling(self, mock_log):
+        filename = os.path.join(self.tmpdir, 'file')
+        open(filename, 'w').close()
+        cache = mgp2pdf.FilterCache(filename)
+        cache.store('key', 'output')
+        self.assertIsNone(cache.get('key'))
+        mock_log.debug.assert_called_with(
+            "Could not store filter output in cache: %s", mock.ANY)
+
+    def runFilter(self, p, command, lines):
+        output = []
+        p._runFilter(command, lines, output.append)
+        return output
+
+    @mock.patch('subprocess.Popen')
+    def test_runFilter(self, mock_Popen):
+        mock_Popen().stdout = mock.MagicMock()
+        mock_Popen().stdout.__iter__.side_effect = lambda: iter([b'Moo!\n'])
+        mock_Popen().wait.return_value = 0
+        mock_Popen.reset_mock()
+        p = mgp2pdf.Presentation(unsafe=True, cache_dir=self.tmpdir,
+                                 cache_filters=True)
+        self.assertEqual(self.runFilter(p, 'cowsay', ['Hello\n']),
+                         ['Moo!\n', None])
+        self.assertEqual(self.runFilter(p, 'cowsay', ['Hello\n']),
+                         ['Moo!\n', None])
+        self.assertEqual(mock_Popen.call_count, 1)
+        self.assertEqual(self.runFilter(p, 'cowsay', ['Bye\n']),
+                         ['Moo!\n', None])
+        self.assertEqual(mock_Popen.call_count, 2)
+
+    @mock.patch('subprocess.Popen')
+    def test_runFilter_failure_not_cached(self, mock_Popen):
+        mock_Popen().stdout = mock.MagicMock()
+        mock_Popen().stdout.__iter__.side_effect = lambda: iter([b'Oops\n'])
+        mock_Popen().wait.return_value = 1
+        mock_Popen.reset_mock()
+        p = mgp2pdf.Presentation(unsafe=True, cache_dir=self.tmpdir,
+                                 cache_filters=True)
+        self.assertEqual(self.runFilter(p, 'cowsay', ['Hello\n']),
+                         ['Oops\n', None])
+        self.assertEqual(self.runFilter(p, 'cowsay', ['Hello\n']),
+                         ['Oops\n', None])
+        self.assertEqual(mock_Popen.call_count, 2)
+
+    def test_requires_cache_dir(self):
+        p = mgp2pdf.Presentation(unsafe=True, cache_filters=True)
+        self.assertFalse(p.cache_filters)
+
+
+WORKER_SCRIPT = r"""
+import os, sys, time
+assert os.environ['MGP2PDF_FILTER_WORKER'] == '1'
+while True:
+    header = sys.stdin.buffer.readline()
+    if not header:
+        break
+    text = sys.stdin.buffer.read(int(header)).decode('UTF-8')
+    if text == 'hang\n':
+        time.sleep(10)
+    elif text == 'die\n':
+        sys.exit(1)
+    elif text == 'junk\n':
+        output = b'junk\n'
+    elif text == 'short\n':
+        sys.stdout.buffer.write(b'100\nshort')
+        sys.exit(1)
+    elif text == 'big\n':
+        output = b'1000\n' + b'x' * 1000
+    else:
+        data = ('%d\n%s' % (os.getpid(), text.upper())).encode('UTF-8')
+        output = b'%d\n%s' % (len(data), data)
+    sys.stdout.buffer.write(output)
+    sys.stdout.buffer.flush()
+"""
+
 
-class TestPresentation(unittest.TestCase):
+@unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+class TestFilterWorker(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+        with open(os.path.join(self.tmpdir, 'worker.py'), 'w') as f:
+            f.write(WORKER_SCRIPT)
+        self.command = '{0} worker.py'.format(sys.executable)
+
+    def makeWorker(self):
+        worker = mgp2pdf.FilterWorker(self.command, cwd=self.tmpdir)
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_run(self):
+        worker = self.makeWorker()
+        pid, output = worker.run(u'Hello \u2603\n').split('\n', 1)
+        self.assertEqual(output, u'HELLO \u2603\n')
+        self.assertEqual(worker.run('again\n'), pid + '\nAGAIN\n')
+        worker.close()
+        worker.close()
+        self.assertNotEqual(worker.run('again\n'), pid + '\nAGAIN\n')
+
+    def test_errors(self):
+        worker = self.makeWorker()
+        for text in ['die\n', 'junk\n', 'short\n']:
+            with self.assertRaises(mgp2pdf.FilterError):
+                worker.run(text)
+            self.assertIsNone(worker.child)
+        self.assertTrue(worker.run('ok\n').endswith('\nOK\n'))
+
+    def test_timeout(self):
+        worker = self.makeWorker()
+        with self.assertRaisesRegex(mgp2pdf.FilterError, 'did not reply'):
+            worker.run('hang\n', timeout=0.2)
+        self.assertTrue(worker.run('ok\n', timeout=5).endswith('\nOK\n'))
+
+    def test_max_output(self):
+        worker = self.makeWorker()
+        with self.assertRaisesRegex(mgp2pdf.FilterError, 'more than 100'):
+            worker.run('big\n', max_output=100)
+        self.assertEqual(len(worker.run('big\n', max_output=1000)), 1000)
+
+    def test_preprocess(self):
+        filename = os.path.join(self.tmpdir, 'slides.mgp')
+        with open(filename, 'w') as f:
+            f.write('%filter "{0}"\none\n%endfilter\n'
+                    '%filter "{0}"\ntwo\n%endfilter\n'
+                    '%filter "echo three"\n%endfilter\n'.format(
+                        self.command))
+        p = mgp2pdf.Presentation(unsafe=True, filter_workers=[self.command])
+        lines = []
+        with mock.patch.object(p, '_handleText', lines.append):
+            with mock.patch.object(p, 'closeFilterWorkers',
+                                   wraps=p.closeFilterWorkers) as close:
+                p.load(filename)
+        close.assert_called_once_with()
+        self.assertEqual(p._filterWorkers, {})
+        self.assertEqual(lines, [lines[0], 'ONE\n', lines[0], 'TWO\n',
+                                 'three\n'])
+
+    def test_preprocess_cached(self):
+        p = mgp2pdf.Presentation(unsafe=True, cache_dir=self.tmpdir,
+                                 cache_filters=True,
+                                 filter_workers=[self.command])
+        p.basedir = self.tmpdir
+        source = ['%filter "{0}"\n'.format(self.command),
+                  'one\n', '%endfilter\n']
+        first = list(p.preprocess(source))
+        p.closeFilterWorkers()
+        self.assertEqual(list(p.preprocess(source)), first)
+        self.assertEqual(p._filterWorkers, {})
+
+
+class TestPresentation(TempDirMixin, unittest.TestCase):
 
     @mock.patch('mgp2pdf.open', create=True)
     def test_load_from_file(self, mock_open):
@@ -152,6 +975,82 @@ class TestPresentation(unittest.TestCase):
                          "--- Slide 1 ---\n"
                          "Hello\n")
 
+    def test_iterSlides(self):
+        p = mgp2pdf.Presentation()
+        slides = p.iterSlides(StringIO('%page\nOne\n%page\nTwo\nThree\n'
+                                       '%page\nFour\n'))
+        self.assertEqual(str(next(slides)), 'One')
+        # the first slide is ready as soon as the second %page is seen
+        self.assertEqual(len(p.slides), 2)
+        self.assertEqual(str(next(slides)), 'Two\nThree')
+        self.assertEqual(len(p.slides), 3)
+        self.assertEqual(str(next(slides)), 'Four')
+        self.assertEqual(list(slides), [])
+        self.assertEqual(len(p.slides), 3)
+
+    def test_iterSlides_without_keeping_slides(self):
+        p = mgp2pdf.Presentation()
+        counts = [len(p.slides) for slide in p.iterSlides(
+            StringIO(sample_mgp), keep=False)]
+        self.assertEqual(counts, [2, 2, 2, 2, 2, 1])
+        self.assertEqual(p.slides, [])
+        self.assertIsNone(p.lineno)
+
+    def test_streamPDF(self):
+        expected = BytesIO()
+        mgp2pdf.Presentation(StringIO(sample_mgp)).makePDF(expected)
+        pdf = BytesIO()
+        p = mgp2pdf.Presentation()
+        p.streamPDF(StringIO(sample_mgp), pdf)
+        self.assertEqual(pdf.getvalue().count(b'/Type /Page\n'),
+                         expected.getvalue().count(b'/Type /Page\n'))
+        self.assertEqual(pdf.getvalue().count(b'/Type /Page\n'), 6)
+        self.assertEqual(p.slides, [])
+
+    def test_streamPDF_empty(self):
+        pdf = BytesIO()
+        mgp2pdf.Presentation().streamPDF(StringIO('%default 1 size 5\n'), pdf)
+        self.assertTrue(pdf.getvalue().startswith(b'%PDF'))
+
+    def test_streamPDF_drawing_error(self):
+        p = mgp2pdf.Presentation()
+        with mock.patch.object(mgp2pdf.Slide, 'drawOn',
+                               side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                p.streamPDF(StringIO(sample_mgp), BytesIO())
+        # drawing errors are not attributed to the line being parsed
+        self.assertIsNone(p.lineno)
+
+    def checkTempFilesCleanedUp(self, generate):
+        from PIL import Image as PILImage
+        tmpdir = self.mkdtemp()
+        PILImage.new('RGB', (400, 300)).save(os.path.join(tmpdir, 'a.png'))
+        tmpdirs = []
+
+        def showPage(canvas):
+            tmpdirs.append(canvas._tmpdir)
+            raise ValueError
+
+        p = mgp2pdf.Presentation(max_image_dpi=10)
+        with mock.patch.object(mgp2pdf.PresentationCanvas, 'showPage',
+                               autospec=True, side_effect=showPage):
+            with self.assertRaises(ValueError):
+                generate(p, StringIO('%page\n%newimage "a.png"\n'), tmpdir)
+        self.assertEqual(len(tmpdirs), 1)
+        self.assertIsNotNone(tmpdirs[0])
+        self.assertFalse(os.path.exists(tmpdirs[0]))
+
+    def test_makePDF_error_cleans_up(self):
+        def generate(p, file, basedir):
+            p.load(file, basedir)
+            p.makePDF(BytesIO())
+        self.checkTempFilesCleanedUp(generate)
+
+    def test_streamPDF_error_cleans_up(self):
+        def generate(p, file, basedir):
+            p.streamPDF(file, BytesIO(), basedir)
+        self.checkTempFilesCleanedUp(generate)
+
     def test_preprocess_errors(self):
         p = mgp2pdf.Presentation()
         # %filter expects an argument that is a quoted string
@@ -184,7 +1083,7 @@ class TestPresentation(unittest.TestCase):
 
     @mock.patch('subprocess.Popen')
     def test_preprocess_unsafe_mode(self, mock_Popen):
-        mock_Popen().communicate.return_value = (b'Moo!\nMoooo!\n', '')
+        mock_Popen().stdout = BytesIO(b'Moo!\nMoooo!\n')
         p = mgp2pdf.Presentation(unsafe=True)
         self.assertEqual(
             list(p.preprocess([
@@ -200,6 +1099,168 @@ class TestPresentation(unittest.TestCase):
                 (5, '# ta-dah!\n'),
             ])
 
+    def test_preprocess_filters_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=10)
+
+        def run_filter(command, lines, emit):
+            barrier.wait()
+            for line in lines:
+                emit(line.upper())
+            emit(None)
+
+        p = mgp2pdf.Presentation(unsafe=True)
+        with mock.patch.object(p, '_runFilter', run_filter):
+            self.assertEqual(
+                list(p.preprocess([
+                    '%filter "one"\n',
+                    'Hello\n',
+                    '%endfilter\n',
+                    'Middle\n',
+                    '%filter "two"\n',
+                    'World\n',
+                    '%endfilter\n',
+                ])), [
+                    (1, 'HELLO\n'),
+                    (4, 'Middle\n'),
+                    (5, 'WORLD\n'),
+                ])
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_preprocess_real_filters(self):
+        p = mgp2pdf.Presentation(unsafe=True)
+        text = ['line %d\n' % n for n in range(20000)]
+        self.assertEqual(
+            list(p.preprocess(['%filter "cat"\n'] + text + ['%endfilter\n',
+                              '%filter "echo hi"\n'] + text + ['%endfilter\n'])),
+            [(1, line) for line in text] + [(20003, 'hi\n')])
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_preprocess_filter_timeout(self):
+        p = mgp2pdf.Presentation(unsafe=True, filter_timeout=0.1)
+        lines = p.preprocess(['%filter "echo hi; sleep 10; echo bye"\n',
+                              '%endfilter\n'])
+        self.assertEqual(next(lines), (1, 'hi\n'))
+        with self.assertRaises(mgp2pdf.FilterError):
+            next(lines)
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_load_filter_timeout_line_number(self):
+        p = mgp2pdf.Presentation(unsafe=True, filter_timeout=0.1)
+        with self.assertRaises(mgp2pdf.FilterError):
+            p.load(StringIO('%page\nText\n%filter "sleep 10"\n%endfilter\n'
+                            'More text\n'))
+        self.assertEqual(p.lineno, 3)
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_pipe_timeout_excludes_backpressure(self):
+        p = mgp2pdf.Presentation(unsafe=True, filter_timeout=0.1)
+        emitted = []
+
+        def emit(line):
+            if not emitted:
+                # the parser is busy for longer than the timeout
+                threading.Event().wait(0.3)
+            emitted.append(line)
+
+        self.assertEqual(p._pipe('echo hi; echo bye', [], emit), 0)
+        self.assertEqual(emitted, ['hi\n', 'bye\n'])
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_preprocess_filter_max_output(self):
+        p = mgp2pdf.Presentation(unsafe=True, filter_max_output=1000)
+        with self.assertRaises(mgp2pdf.FilterError):
+            list(p.preprocess(['%filter "yes"\n', '%endfilter\n']))
+
+    def test_preprocess_filter_output_is_bounded(self):
+        emitted = []
+        queue_full = threading.Event()
+
+        def run_filter(command, lines, emit):
+            for n in range(100):
+                emit('%s %d\n' % (command, n))
+                emitted.append(command)
+                if emitted.count('two') == 5:
+                    queue_full.set()
+            emit(None)
+
+        p = mgp2pdf.Presentation(unsafe=True)
+        p.filterQueueSize = 5
+        with mock.patch.object(p, '_runFilter', run_filter):
+            lines = p.preprocess([
+                '%filter "one"\n',
+                '%endfilter\n',
+                '%filter "two"\n',
+                '%endfilter\n',
+            ])
+            self.assertEqual(next(lines), (1, 'one 0\n'))
+            self.assertTrue(queue_full.wait(10))
+            # "two" waits for the parser instead of buffering all its output
+            self.assertEqual(emitted.count('two'), 5)
+            rest = list(lines)
+        self.assertEqual(len(rest), 199)
+        self.assertEqual(rest[-1], (3, 'two 99\n'))
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_preprocess_stopped_early_kills_filters(self):
+        executors = []
+
+        def make_executor(*args, **kw):
+            executors.append(ThreadPoolExecutor(*args, **kw))
+            return executors[-1]
+
+        p = mgp2pdf.Presentation(unsafe=True)
+        p.filterQueueSize = 5
+        with mock.patch('concurrent.futures.ThreadPoolExecutor',
+                        make_executor):
+            lines = p.preprocess([
+                '%filter "echo one"\n',
+                '%endfilter\n',
+                '%filter "echo $$; exec sleep 10"\n',
+                '%endfilter\n',
+                '%filter "yes"\n',
+                '%endfilter\n',
+            ])
+            self.assertEqual(next(lines), (1, 'one\n'))
+            lineno, pid = next(lines)
+        lines.close()
+        # Both the filter that's idle and the one that's blocked on a full
+        # queue are stopped, so this doesn't hang
+        executors[0].shutdown(wait=True)
+        self.assertEqual(p._filterChildren, set())
+        with self.assertRaises(OSError):
+            os.kill(int(pid), 0)
+
+    @unittest.skipIf(sys.platform == 'win32', 'needs a POSIX shell')
+    def test_pipe_cancelled(self):
+        def emit(line):
+            raise mgp2pdf._FilterCancelled()
+
+        p = mgp2pdf.Presentation(unsafe=True)
+        with self.assertRaises(mgp2pdf._FilterCancelled):
+            p._pipe('echo hi; exec sleep 10', [], emit)
+        self.assertEqual(p._filterChildren, set())
+
+    def test_killProcessGroup_when_already_dead(self):
+        child = mock.Mock(pid=-1)
+        with mock.patch('os.killpg', side_effect=OSError, create=True):
+            mgp2pdf._killProcessGroup(child)
+
+    def test_preprocess_error_after_filter(self):
+        p = mgp2pdf.Presentation(unsafe=True)
+        lines = []
+        with mock.patch.object(p, '_runFilter',
+                               lambda command, lines, emit: [
+                                   emit('Moo!\n'), emit(None)]):
+            with self.assertRaises(mgp2pdf.MgpSyntaxError):
+                for lineno, line in p.preprocess([
+                    '%filter "cowsay"\n',
+                    'Hello\n',
+                    '%endfilter\n',
+                    '%endfilter\n',
+                ]):
+                    lines.append((lineno, line))
+        self.assertEqual(lines, [(1, 'Moo!\n')])
+
     @mock.patch('mgp2pdf.open', create=True)
     def test_preprocess_includes(self, mock_open):
         p = mgp2pdf.Presentation()
@@ -218,19 +1279,38 @@ class TestPresentation(unittest.TestCase):
             ])
 
     def test_special_directives(self):
-        p = mgp2pdf.Presentation()
         args = []
-        p._handleSpecialDirective_test = args.append
+
+        class Presentation(mgp2pdf.Presentation):
+            def _handleSpecialDirective_test(self, parts):
+                args.append(parts)
+
+        p = Presentation()
         p._handleDirectives('%test 5 foo x y, bar "a, b", baz')
         self.assertEqual(args,
                          [['test', '5', 'foo x y', 'bar "a, b"', 'baz']])
+        self.assertNotIn('test', mgp2pdf.Presentation._specialDirectiveHandlers)
+
+    def test_directive_handlers_can_be_overridden(self):
+        sizes = []
+
+        class Presentation(mgp2pdf.Presentation):
+            def _handleDirective_size(self, parts):
+                sizes.append(parts)
+
+        p = Presentation()
+        p._handleDirectives('%page, size 5, vgap 10')
+        self.assertEqual(sizes, [['size', '5']])
+        self.assertEqual(p.slides[-1].vgap, 10)
 
     @mock.patch('mgp2pdf.log')
     def test_empty_directive(self, mock_log):
         p = mgp2pdf.Presentation()
-        # XXX: "%page,,size 5" doesn't trigger this because _splitDirectives()
-        # is buggy and collapses runs of commas.
         p._handleDirectives('%page, ,size 5')
+        mock_log.debug.assert_called_with("Ignoring empty directive on line None")
+        mock_log.reset_mock()
+        p._handleDirectives('%page,,size 5')
+        mock_log.debug.assert_called_with("Ignoring empty directive on line None")
 
     @mock.patch('mgp2pdf.log')
     def test_unknown_directives(self, mock_log):
@@ -280,6 +1360,8 @@ class TestPresentation(unittest.TestCase):
             return
         p = mgp2pdf.Presentation()
         p._handleDirectives('%deffont "mono" xfont "Monospace"')
+        self.assertEqual(p.fonts.definitions,
+                         [('mono', 'xfont', 'Monospace')])
         p._handleDirectives('%deffont "bold" xfont "Sans-bold"')
         p._handleDirectives('%deffont "bolditalic" xfont "Sans-bold-i"')
         p._handleDirectives('%page')
@@ -291,6 +1373,7 @@ class TestPresentation(unittest.TestCase):
         self.assertRaises(NotImplementedError, p._handleDirectives,
                           '%deffont "B0rk" tex "Computer Modern"')
 
+    @mock.patch('shutil.which', mock.Mock(return_value='/usr/bin/fc-match'))
     @mock.patch('subprocess.Popen')
     def test_deffont_unsupported_font(self, mock_Popen):
         p = mgp2pdf.Presentation()
@@ -311,6 +1394,25 @@ class TestPresentation(unittest.TestCase):
         self.assertRaises(mgp2pdf.MgpSyntaxError, p._handleDirectives,
                           '%default 1 left')
 
+    @mock.patch('mgp2pdf.log')
+    def test_default_application(self, mock_log):
+        p = mgp2pdf.Presentation()
+        p._handleDirectives('%default 1 size 7, fore "red", frobnicate')
+        p._handleDirectives('%default 2 size 8, mark, again, size 4')
+        p._handleDirectives('%page')
+        p._handleDirectives('%size 3')
+        p._handleText('Hello')
+        p._handleText('World')
+        hello = p.slides[-1].lines[0].chunks[0]
+        world = p.slides[-1].lines[-1].chunks[-1]
+        # explicit directives override the defaults
+        self.assertEqual((hello.fontSize, hello.color),
+                         (3, mgp2pdf.parse_color('red')))
+        # %again starts a new line, so the second size applies too
+        self.assertEqual((world.text, world.fontSize), ('World', 4))
+        mock_log.debug.assert_called_once_with(
+            "Ignoring unrecognized directive %frobnicate on line None")
+
     def test_tab(self):
         p = mgp2pdf.Presentation()
         p._handleDirectives('%tab 1')
@@ -352,10 +1454,288 @@ class TestPresentation(unittest.TestCase):
         self.assertEqual(image.zoom, 50)
         self.assertEqual(image.raised_by, 14)
 
+    def test_parallel_layout(self):
+        source = sample_mgp + sample_mgp[sample_mgp.index('%page'):] * 2
+        p = mgp2pdf.Presentation(StringIO(source))
+        p.slides[0].layOut(mgp2pdf.PresentationCanvas(BytesIO()), p.pageSize)
+        first_slide = p.slides[0]
+        expected = mgp2pdf.Presentation(StringIO(source))
+        canvas = mgp2pdf.PresentationCanvas(BytesIO())
+        for slide in expected.slides:
+            slide.layOut(canvas, expected.pageSize)
+        p.makePDF(BytesIO(), jobs=2)
+        self.assertEqual(str(p), str(expected))
+        self.assertTrue(all(s.wrapped for s in p.slides))
+        # slides that were already laid out are not sent to the workers
+        self.assertIs(p.slides[0], first_slide)
+        # once everything is laid out, there's no need for worker processes
+        with mock.patch('concurrent.futures.ProcessPoolExecutor') as pool:
+            p.layOut(jobs=2)
+        self.assertFalse(pool.called)
+
+    def test_layOutSlides(self):
+        p = mgp2pdf.Presentation(StringIO(sample_mgp))
+        slides = mgp2pdf._layOutSlides(p.slides, p.pageSize)
+        self.assertTrue(all(s.wrapped for s in slides))
+
+    @mock.patch.dict(mgp2pdf.Fonts._parsed, clear=True)
+    @mock.patch('mgp2pdf.TTFont')
+    @mock.patch('mgp2pdf.pdfmetrics')
+    def test_initLayoutWorker(self, mock_pdfmetrics, mock_TTFont):
+        mock_pdfmetrics.getRegisteredFontNames.return_value = ['mono']
+        mgp2pdf._initLayoutWorker({'mono': '/mono.ttf', 'bold': '/bold.ttf'})
+        mock_TTFont.assert_called_once_with('bold', '/bold.ttf')
+        mock_pdfmetrics.registerFont.assert_called_once_with(mock_TTFont())
+
+
+@mock.patch.dict(mgp2pdf.Fonts._parsed, clear=True)
+@mock.patch.dict(mgp2pdf.Fonts._resolved, clear=True)
+class TestFonts(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+        self.fontfile = os.path.join(self.tmpdir, 'Font.ttf')
+        open(self.fontfile, 'w').close()
+        patcher = mock.patch.object(mgp2pdf.Fonts, '_fcMatch',
+                                    return_value=self.fontfile)
+        self.fcMatch = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('shutil.which', return_value='/usr/bin/fc-match')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_findFontFile_in_process(self):
+        fonts = mgp2pdf.Fonts()
+        self.assertEqual(fonts.findFontFile('Sans'), self.fontfile)
+        self.assertEqual(mgp2pdf.Fonts().findFontFile('Sans'), self.fontfile)
+        self.assertEqual(self.fcMatch.call_count, 1)
+
+    def test_findFontFile_not_found(self):
+        self.fcMatch.return_value = ''
+        self.assertIsNone(mgp2pdf.Fonts().findFontFile('Nope'))
+        self.assertIsNone(mgp2pdf.Fonts().findFontFile('Nope'))
+        self.assertEqual(self.fcMatch.call_count, 2)
+
+    def test_findFontFile_on_disk(self):
+        cachedir = os.path.join(self.tmpdir, 'cache')
+        mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+        mgp2pdf.Fonts._resolved.clear()
+        fonts = mgp2pdf.Fonts(cachedir)
+        self.assertEqual(fonts.findFontFile('Sans'), self.fontfile)
+        self.assertEqual(self.fcMatch.call_count, 1)
+        # font file changes invalidate the cache
+        mgp2pdf.Fonts._resolved.clear()
+        with open(self.fontfile, 'w') as f:
+            f.write('changed')
+        mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+        self.assertEqual(self.fcMatch.call_count, 2)
+        # fontconfig configuration changes invalidate the cache
+        mgp2pdf.Fonts._resolved.clear()
+        with mock.patch.object(mgp2pdf.Fonts, 'fontconfigPaths',
+                               [self.fontfile]):
+            mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+        self.assertEqual(self.fcMatch.call_count, 3)
+        mgp2pdf.Fonts._resolved.clear()
+        with mock.patch.dict(os.environ, FONTCONFIG_FILE=self.fontfile):
+            mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+        self.assertEqual(self.fcMatch.call_count, 4)
+
+    def test_findFontFile_on_disk_font_subdirectory(self):
+        cachedir = os.path.join(self.tmpdir, 'cache')
+        subdir = os.path.join(self.tmpdir, 'fonts', 'truetype')
+        os.makedirs(subdir)
+        with mock.patch.object(mgp2pdf.Fonts, 'fontconfigPaths',
+                               [os.path.dirname(subdir)]):
+            mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+            # fonts installed in subdirectories invalidate the cache
+            mgp2pdf.Fonts._resolved.clear()
+            open(os.path.join(subdir, 'New.ttf'), 'w').close()
+            os.utime(subdir, (0, 0))
+            mgp2pdf.Fonts(cachedir).findFontFile('Sans')
+        self.assertEqual(self.fcMatch.call_count, 2)
+
+    def test_findFontFile_on_disk_concurrent(self):
+        cachedir = os.path.join(self.tmpdir, 'cache')
+        one = mgp2pdf.Fonts(cachedir)
+        two = mgp2pdf.Fonts(cachedir)
+        one._diskCache()
+        two._diskCache()
+        one.findFontFile('Sans')
+        two.findFontFile('Serif')
+        # the second process doesn't overwrite what the first one stored
+        mgp2pdf.Fonts._resolved.clear()
+        fonts = mgp2pdf.Fonts(cachedir)
+        fonts.findFontFile('Sans')
+        fonts.findFontFile('Serif')
+        self.assertEqual(self.fcMatch.call_count, 2)
+
+    @mock.patch('mgp2pdf.log')
+    def test_findFontFile_cannot_save(self, mock_log):
+        fonts = mgp2pdf.Fonts(self.fontfile)
+        self.assertEqual(fonts.findFontFile('Sans'), self.fontfile)
+        self.assertTrue(mock_log.debug.called)
+
+    def test_loadFont(self):
+        shutil.copy(os.path.join(os.path.dirname(reportlab.__file__),
+                                 'fonts', 'Vera.ttf'), self.fontfile)
+        font1 = mgp2pdf.Fonts.loadFont('one', self.fontfile)
+        font2 = mgp2pdf.Fonts.loadFont('two', self.fontfile)
+        self.assertIsNone(font1.parseTime)
+        self.assertIsNotNone(font2.parseTime)
+        self.assertEqual(font2.fontName, 'two')
+        self.assertIs(font1.face, font2.face)
+        self.assertIsNot(font1.state, font2.state)
+        self.assertIsNot(font1.encoding, font2.encoding)
+        self.assertEqual(font1.stringWidth('Hello', 10),
+                         font2.stringWidth('Hello', 10))
+        # modified font files are parsed again
+        with open(self.fontfile, 'ab') as f:
+            f.write(b'\0')
+        font3 = mgp2pdf.Fonts.loadFont('three', self.fontfile)
+        self.assertIsNone(font3.parseTime)
+        self.assertIsNot(font1.face, font3.face)
+        self.assertEqual(len(mgp2pdf.Fonts._parsed), 1)
+
+    def test_shapable(self):
+        self.assertTrue(mgp2pdf._shapable('one'))
+        unshaped = mgp2pdf.rl_config.unShapedFontGlob
+        unshaped.append('two*')
+        self.addCleanup(unshaped.remove, 'two*')
+        self.assertTrue(mgp2pdf._shapable('one'))
+        self.assertFalse(mgp2pdf._shapable('two-bold'))
+
+    @mock.patch('mgp2pdf.pdfmetrics')
+    def test_define_reuses_fonts(self, mock_pdfmetrics):
+        shutil.copy(os.path.join(os.path.dirname(reportlab.__file__),
+                                 'fonts', 'Vera.ttf'), self.fontfile)
+        fonts = mgp2pdf.Fonts()
+        fonts.define('one', 'xfont', 'Sans')
+        fonts.define('two', 'xfont', 'Sans')
+        self.assertEqual((fonts.parsed, fonts.reused), (1, 1))
+        self.assertGreater(fonts.parseTimeSaved, 0)
+
+    @mock.patch.object(mgp2pdf.Fonts, '_index', None)
+    @mock.patch.object(mgp2pdf.Fonts, 'fontDirectories')
+    def test_findFontFile_index(self, mock_fontDirectories):
+        mock_fontDirectories.__iter__.return_value = [self.tmpdir]
+        fontfile = os.path.join(self.tmpdir, 'DejaVuSans.ttf')
+        with open(fontfile, 'wb') as f:
+            f.write(make_ttf('DejaVu Sans'))
+        with mock.patch('shutil.which', return_value=None):
+            fonts = mgp2pdf.Fonts()
+        self.assertTrue(fonts.use_index)
+        self.assertEqual(fonts.findFontFile('Sans'), fontfile)
+        self.assertIs(mgp2pdf.Fonts.fontIndex(), mgp2pdf.Fonts.fontIndex())
+        self.assertFalse(self.fcMatch.called)
+
+
+def make_ttf(family, weight=400, fsSelection=0, names=None, os2=True):
+    """Build a minimal TrueType file with 'name' and 'OS/2' tables."""
+    if names is None:
+        names = [(3, 1, 0x409, 1, family.encode('UTF-16-BE'))]
+    strings = b''
+    records = b''
+    for platformID, encodingID, languageID, nameID, text in names:
+        records += struct.pack('>HHHHHH', platformID, encodingID, languageID,
+                               nameID, len(text), len(strings))
+        strings += text
+    tables = {b'name': struct.pack('>HHH', 0, len(names), 6 + len(records))
+              + records + strings}
+    if os2:
+        tables[b'OS/2'] = (struct.pack('>HHH', 3, 0, weight) + b'\0' * 56
+                           + struct.pack('>H', fsSelection) + b'\0' * 32)
+    header = struct.pack('>4sHHHH', b'\0\1\0\0', len(tables), 0, 0, 0)
+    offset = len(header) + 16 * len(tables)
+    directory = data = b''
+    for tag, table in sorted(tables.items()):
+        directory += struct.pack('>4sLLL', tag, 0, offset + len(data),
+                                 len(table))
+        data += table
+    return header + directory + data
+
+
+class TestFontIndex(TempDirMixin, unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = self.mkdtemp()
+
+    def makeFont(self, filename, *args, **kw):
+        filename = os.path.join(self.tmpdir, filename)
+        with open(filename, 'wb') as f:
+            f.write(make_ttf(*args, **kw))
+        return filename
+
+    def test_weightFromOpenType(self):
+        self.assertEqual(mgp2pdf._weightFromOpenType(7), 200)
+        self.assertEqual(mgp2pdf._weightFromOpenType(1000), 215)
+        self.assertEqual(mgp2pdf._weightFromOpenType(2000), 215)
+
+    def test_readFontInfo(self):
+        fn = self.makeFont('a.ttf', 'Foo', weight=700, fsSelection=1)
+        self.assertEqual(mgp2pdf.readFontInfo(fn), ('Foo', 200, 100))
+        fn = self.makeFont('b.ttf', 'Foo', fsSelection=0x200)
+        self.assertEqual(mgp2pdf.readFontInfo(fn), ('Foo', 80, 110))
+        fn = self.makeFont('c.ttf', 'Foo', os2=False)
+        self.assertEqual(mgp2pdf.readFontInfo(fn), ('Foo', 80, 0))
+
+    def test_readFontInfo_names(self):
+        fn = self.makeFont('a.ttf', None, names=[
+            (1, 0, 0, 1, b'Mac Name'),
+            (3, 1, 0x409, 2, u'Bold'.encode('UTF-16-BE')),
+            (3, 1, 0x407, 1, u'German Name'.encode('UTF-16-BE')),
+            (3, 1, 0x409, 1, u'English Name'.encode('UTF-16-BE')),
+            (1, 0, 5, 1, b'Other Mac Name'),
+        ])
+        self.assertEqual(mgp2pdf.readFontInfo(fn)[0], 'English Name')
+        fn = self.makeFont('b.ttf', None, names=[
+            (1, 0, 0, 1, b'Mac Name'),
+            (3, 1, 0x409, 16, u'Typographic'.encode('UTF-16-BE')),
+        ])
+        self.assertEqual(mgp2pdf.readFontInfo(fn)[0], 'Typographic')
+        fn = self.makeFont('c.ttf', None, names=[(1, 0, 0, 1, b'Mac Name')])
+        self.assertEqual(mgp2pdf.readFontInfo(fn)[0], 'Mac Name')
+
+    def test_readFontInfo_not_a_font(self):
+        fn = os.path.join(self.tmpdir, 'a.ttf')
+        with open(fn, 'wb') as f:
+            f.write(b'OTTO\0\0')
+        self.assertIsNone(mgp2pdf.readFontInfo(fn))
+        with open(fn, 'wb') as f:
+            f.write(b'\0\1\0')
+        self.assertIsNone(mgp2pdf.readFontInfo(fn))
+        self.assertIsNone(mgp2pdf.readFontInfo(self.tmpdir + '/nope.ttf'))
+
+    def test_match(self):
+        os.mkdir(os.path.join(self.tmpdir, 'sub'))
+        regular = self.makeFont('sub/Regular.ttf', 'Liberation Sans')
+        bold = self.makeFont('sub/Bold.ttf', 'Liberation Sans', weight=700)
+        italic = self.makeFont('Italic.TTF', 'Liberation Sans', fsSelection=1)
+        mono = self.makeFont('Mono.ttf', 'DejaVu Sans Mono')
+        self.makeFont('README', 'Not a font')
+        with open(os.path.join(self.tmpdir, 'bad.ttf'), 'w') as f:
+            f.write('not a font')
+        index = mgp2pdf.FontIndex([self.tmpdir])
+        self.assertEqual(index.match('Liberation Sans'), regular)
+        self.assertEqual(index.match('liberation-sans:bold'), bold)
+        self.assertEqual(index.match('Helvetica:weight=bold'), bold)
+        self.assertEqual(index.match('Helvetica:weight=200'), bold)
+        self.assertEqual(index.match('Arial:italic'), italic)
+        self.assertEqual(index.match('Arial:slant=italic'), italic)
+        self.assertEqual(index.match('Arial:slant=100:weight=200'), italic)
+        self.assertEqual(index.match('Arial:weight=heavy:slant=upright'), bold)
+        self.assertEqual(index.match('Arial:foo=bar:unknown'), regular)
+        self.assertEqual(index.match('Courier'), mono)
+        self.assertEqual(index.match('Nonexistent'), regular)
+
+    def test_match_anything(self):
+        fn = self.makeFont('Font.ttf', 'Obscure')
+        self.assertEqual(mgp2pdf.FontIndex([self.tmpdir]).match('Sans'), fn)
+        self.assertIsNone(mgp2pdf.FontIndex().match('Sans'))
+
 
 @mock.patch('sys.stdout', StringIO())
 @mock.patch('sys.stderr', StringIO())
-class TestMain(unittest.TestCase):
+class TestMain(TempDirMixin, unittest.TestCase):
 
     def test_no_args(self):
         self.assertRaises(SystemExit, mgp2pdf.main, [])
@@ -377,6 +1757,177 @@ class TestMain(unittest.TestCase):
         mgp2pdf.main(['file1.mgp', '-o', '/tmp/', '-v'])
         mgp2pdf.main(['file1.mgp', '-o', '/tmp/file1.pdf'])
 
+    def test_bad_jobs(self):
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '-j', '0'])
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--layout-jobs', '0'])
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--max-image-dpi', '0'])
+
+    def test_bad_filter_limits(self):
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--filter-timeout', '0'])
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--filter-max-output', '0'])
+
+    @mock.patch.dict(os.environ)
+    def test_cache_filters_requires_cache_dir(self):
+        os.environ.pop('MGP2PDF_CACHE_DIR', None)
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--cache-filters'])
+
+    def test_stream_conflicts(self):
+        self.assertRaises(SystemExit, mgp2pdf.main, ['x.mgp', '--stream', '-v'])
+        self.assertRaises(SystemExit, mgp2pdf.main,
+                          ['x.mgp', '--stream', '--layout-jobs', '2'])
+
+    def test_stream(self):
+        tmpdir = self.mkdtemp()
+        good = os.path.join(tmpdir, 'good.mgp')
+        bad = os.path.join(tmpdir, 'bad.mgp')
+        with open(good, 'w') as f:
+            f.write(sample_mgp)
+        with open(bad, 'w') as f:
+            f.write('%page\nHello\n%fore "fuchsia"\n')
+        start = sys.stdout.tell()
+        self.assertEqual(mgp2pdf.main(['--stream', good, bad]), 1)
+        self.assertTrue(os.path.exists(os.path.join(tmpdir, 'good.pdf')))
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, 'bad.pdf')))
+        output = sys.stdout.getvalue()[start:]
+        self.assertIn('Error converting %s: MgpSyntaxError: ' % bad, output)
+        self.assertIn(' (line 3)', output)
+        deps = set()
+        self.assertFalse(mgp2pdf.convert(bad, stream=True, dependencies=deps))
+        self.assertEqual(deps, {bad})
+
+    @mock.patch('mgp2pdf.Presentation')
+    def test_exit_status(self, mock_Presentation):
+        self.assertEqual(mgp2pdf.main(['file1.mgp', '-o', '/tmp/']), 0)
+        mock_Presentation().load.side_effect = IOError('no such file')
+        self.assertEqual(mgp2pdf.main(['file1.mgp', 'file2.mgp', '-o', '/tmp/']), 1)
+
+    def test_parallel_conversion(self):
+        tmpdir = self.mkdtemp()
+        good = os.path.join(tmpdir, 'good.mgp')
+        bad = os.path.join(tmpdir, 'bad.mgp')
+        other = os.path.join(tmpdir, 'other.mgp')
+        with open(good, 'w') as f:
+            f.write(sample_mgp)
+        with open(bad, 'w') as f:
+            f.write('text in preamble\n')
+        with open(other, 'w') as f:
+            f.write(sample_mgp)
+        start = sys.stdout.tell()
+        rc = mgp2pdf.main(['-j', '2', '-v', good, bad, other])
+        self.assertEqual(rc, 1)
+        for name in ['good.pdf', 'other.pdf']:
+            with open(os.path.join(tmpdir, name), 'rb') as f:
+                pdf = f.read()
+            self.assertTrue(pdf.startswith(b'%PDF-'))
+            self.assertTrue(pdf.rstrip().endswith(b'%%EOF'))
+        self.assertFalse(os.path.exists(os.path.join(tmpdir, 'bad.pdf')))
+        output = sys.stdout.getvalue()[start:]
+        # output of each file is kept together, in command-line order
+        self.assertEqual(output.count('--- Slide 1 ---'), 2)
+        self.assertLess(output.index('--- Slide 6 ---'),
+                        output.index('Error loading %s' % bad))
+        self.assertLess(output.index('Error loading %s' % bad),
+                        output.rindex('--- Slide 1 ---'))
+        self.assertIn('1 of 3 files could not be converted', output)
+
+    @mock.patch('mgp2pdf.ImageReader')
+    def test_convert_dependencies(self, mock_ImageReader):
+        mock_ImageReader().getSize.return_value = 10, 10
+        tmpdir = self.mkdtemp()
+        fn = os.path.join(tmpdir, 'talk.mgp')
+        with open(fn, 'w') as f:
+            f.write('%include "preamble.mgp"\n%page\n%newimage "logo.png"\n')
+        with open(os.path.join(tmpdir, 'preamble.mgp'), 'w') as f:
+            f.write('%default 1 size 5\n')
+        deps = set()
+        self.assertTrue(mgp2pdf.convert(fn, dependencies=deps))
+        self.assertEqual(deps, {fn, os.path.join(tmpdir, 'preamble.mgp'),
+                                os.path.join(tmpdir, 'logo.png')})
+        # dependencies are recorded even if loading fails
+        os.unlink(os.path.join(tmpdir, 'preamble.mgp'))
+        deps = set()
+        self.assertFalse(mgp2pdf.convert(fn, dependencies=deps))
+        self.assertEqual(deps, {fn, os.path.join(tmpdir, 'preamble.mgp')})
+
+    @mock.patch('time.sleep')
+    def test_waitForChanges(self, mock_sleep):
+        stamps = iter([
+            # first poll: nothing changed
+            (1, 10), (1, 10),
+            # second poll: b changed
+            (1, 10), (2, 20),
+            # debounce: b is still being written
+            (1, 10), (3, 30),
+            # debounce: b settled down
+            (1, 10), (3, 30),
+        ])
+        with mock.patch('mgp2pdf.fileStamp', lambda fn: next(stamps)):
+            changed = mgp2pdf.waitForChanges({'a': (1, 10), 'b': (1, 10)},
+                                             interval=1, debounce=0.1)
+        self.assertEqual(changed, {'b'})
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(1), mock.call(1), mock.call(0.1),
+                          mock.call(0.1)])
+
+    @mock.patch('mgp2pdf.fileStamp', lambda fn: None)
+    @mock.patch('mgp2pdf.waitForChanges')
+    @mock.patch('mgp2pdf.convert')
+    def test_watch(self, mock_convert, mock_waitForChanges):
+        deps = {
+            'a.mgp': {'a.mgp', 'logo.png', 'old.png'},
+            'b.mgp': {'b.mgp', 'logo.png'},
+        }
+
+        def convert(fn, dependencies, **kw):
+            dependencies.update(deps[fn])
+            if fn == 'a.mgp':
+                deps[fn] = {'a.mgp', 'logo.png'}
+
+        mock_convert.side_effect = convert
+        mock_waitForChanges.side_effect = [{'a.mgp'}, {'logo.png'},
+                                           KeyboardInterrupt]
+        mgp2pdf.watch(['a.mgp', 'b.mgp'], outfile='/tmp')
+        self.assertEqual([c[0][0] for c in mock_convert.call_args_list],
+                         ['a.mgp', 'b.mgp', 'a.mgp', 'a.mgp', 'b.mgp'])
+        # old.png is no longer watched after a.mgp stopped using it
+        self.assertEqual(set(mock_waitForChanges.call_args[0][0]),
+                         {'a.mgp', 'b.mgp', 'logo.png'})
+
+    @mock.patch('mgp2pdf.convert')
+    def test_no_cache(self, mock_convert):
+        mgp2pdf.main(['--cache-dir', '/tmp/cache', 'a.mgp'])
+        self.assertEqual(mock_convert.call_args[1]['cache_dir'], '/tmp/cache')
+        mgp2pdf.main(['--cache-dir', '/tmp/cache', '--no-cache', 'a.mgp'])
+        self.assertIsNone(mock_convert.call_args[1]['cache_dir'])
+        # --no-cache wins over --cache-filters
+        mgp2pdf.main(['--cache-dir', '/tmp/cache', '--cache-filters',
+                      '--no-cache', 'a.mgp'])
+        self.assertIsNone(mock_convert.call_args[1]['cache_dir'])
+        self.assertFalse(mock_convert.call_args[1]['cache_filters'])
+
+    @mock.patch('mgp2pdf.watch')
+    def test_main_watch(self, mock_watch):
+        self.assertEqual(mgp2pdf.main(['--watch', 'a.mgp']), 0)
+        self.assertEqual(mock_watch.call_args[0][0], ['a.mgp'])
+
+    def test_convertInWorker(self):
+        success, output = mgp2pdf._convertInWorker(
+            ('/nonexistent/file.mgp', dict(verbose=True)))
+        self.assertFalse(success)
+        self.assertIn('Loading /nonexistent/file.mgp\n', output)
+        self.assertIn('Error loading /nonexistent/file.mgp', output)
+
+    @mock.patch('mgp2pdf.Fonts.findFontFile', return_value=None)
+    def test_convertInWorker_exit(self, mock_findFontFile):
+        tmpdir = self.mkdtemp()
+        fn = os.path.join(tmpdir, 'talk.mgp')
+        with open(fn, 'w') as f:
+            f.write('%deffont "standard" xfont "nosuchfont"\n%page\nHi\n')
+        success, output = mgp2pdf._convertInWorker((fn, {}))
+        self.assertFalse(success)
+        self.assertIn('Error converting %s: Could not find the font file'
+                      ' for nosuchfont' % fn, output)
+
 
 def test_suite():
     return unittest.TestSuite([